@@ -0,0 +1,210 @@
+#!/usr/bin/env	python3
+
+"""
+Measure how get_mutation_profile.py scales using synthetic alignments and mutation lists
+"""
+
+import os
+import time
+import argparse
+import textwrap
+import tempfile
+import datetime
+import itertools
+import tracemalloc
+import contextlib
+import numpy
+import pandas
+import get_mutation_profile as gmp
+
+
+# functions	----------
+
+def write_record(out, name, seq, width=60):
+	""" write a sequence in fasta format
+	input: open file, sequence name and array of ASCII codes """
+
+	out.write(b">" + name + b"\n")
+	data = seq.tobytes()
+	out.write(b"\n".join(data[i:i + width] for i in range(0, len(data), width)) + b"\n")
+
+
+def make_alignment(filename, nsamples, length, gap_rate, mutation_rate, rng):
+	""" write a synthetic alignment with a reference (REF) including gaps and sequences derived from it
+	input: output fasta, number of sequences, alignment length, gap and mutation rates and random generator
+	output: ungapped reference sequence """
+
+	nucl = numpy.frombuffer(b"ACGT", dtype=numpy.uint8)
+	ref = nucl[rng.integers(0, 4, length)]
+	ref[rng.random(length) < gap_rate] = ord("-")
+
+	with open(filename, "wb") as out:
+		write_record(out, b"REF", ref)
+		for i in range(nsamples):
+			seq = ref.copy()
+			insertion = (seq == ord("-")) & (rng.random(length) < 0.5)
+			seq[insertion] = nucl[rng.integers(0, 4, insertion.sum())]
+			mutated = rng.random(length) < mutation_rate
+			seq[mutated] = nucl[rng.integers(0, 4, mutated.sum())]
+			seq[rng.random(length) < gap_rate / 10] = ord("-")
+			write_record(out, b"S" + str(i).encode(), seq)
+
+	return ref[ref != ord("-")].tobytes().decode()
+
+
+def make_mutations(workdir, ref_seq_nogaps, nsamples, npositions, window, rng):
+	""" write the mutation lists of the three input options
+	input: working directory, ungapped reference, number of samples and positions, motif window and random generator
+	output: dictionary with the file of each option """
+
+	first, last = window + 2, len(ref_seq_nogaps) - window - 1
+	positions = numpy.sort(rng.choice(numpy.arange(first, last), size=min(npositions, last - first), replace=False))
+	ref = numpy.array(list(ref_seq_nogaps))[positions - 1]
+	alt = numpy.array(list("ACGT"))[(numpy.searchsorted(list("ACGT"), ref) + rng.integers(1, 4, len(ref))) % 4]
+
+	files = {"OPTION1": os.path.join(workdir, "positions.txt"), "OPTION2": os.path.join(workdir, "mutations.tsv"), "OPTION3": os.path.join(workdir, "samples.tsv")}
+	pandas.DataFrame({"position": positions}).to_csv(files["OPTION1"], index = False, header=True, sep ="\t")
+	pandas.DataFrame({"POS": positions, "REF": ref, "ALT": alt}).to_csv(files["OPTION2"], index = False, header=True, sep ="\t")
+
+	ids = numpy.repeat(["S" + str(i) for i in range(nsamples)], len(positions))
+	alt3 = numpy.array(list("ACGT"))[(numpy.tile(numpy.searchsorted(list("ACGT"), ref), nsamples) + rng.integers(1, 4, len(ids))) % 4]
+	pandas.DataFrame({"ID": ids, "POS": numpy.tile(positions, nsamples), "REF": numpy.tile(ref, nsamples), "ALT": alt3}).to_csv(files["OPTION3"], index = False, header=True, sep ="\t")
+
+	return files
+
+
+def measure(function, memory):
+	""" run a function measuring its wall-clock time or the peak of memory it allocates
+	input: function without arguments and whether memory should be traced
+	output: result of the function, seconds and peak memory (MB) """
+
+	if memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		result = function()
+	seconds = time.perf_counter() - start
+	peak = None
+	if memory:
+		peak = tracemalloc.get_traced_memory()[1] / 2**20
+		tracemalloc.stop()
+
+	return result, seconds, peak
+
+
+def run_option(option, fasta, mutation_file, workdir, args, memory):
+	""" run the stages of get_mutation_profile.py for one input option
+	input: option, fasta, mutation list, working directory, arguments and whether memory should be traced
+	output: list of [stage, rows, seconds, peak memory] """
+
+	stages = []
+
+	sequences, seconds, peak = measure(lambda: gmp.load_fasta(fasta), memory)
+	stages.append(["load_fasta", len(sequences), seconds, peak])
+	ref_seq = sequences.sequence("REF")
+
+	if option == "OPTION1":
+		mutation_df, seconds, peak = measure(lambda: pandas.read_table(mutation_file), memory)
+	else:
+		mutation_df, seconds, peak = measure(lambda: pandas.concat(gmp.read_mutations(mutation_file, args.chunk_size)), memory)
+	stages.append(["read_mutations", len(mutation_df), seconds, peak])
+
+	coords, seconds, peak = measure(lambda: gmp.get_ref_coords(ref_seq), memory)
+	stages.append(["get_ref_coords", len(coords), seconds, peak])
+
+	mx, seconds, peak = measure(lambda: gmp.mut_profile(sequences, args.before, args.after, "REF", ref_seq, coords, args.profiles, mutation_df, args.threads), memory)
+	stages.append(["mut_profile", len(mx), seconds, peak])
+
+	result, seconds, peak = measure(lambda: gmp.summary(mx, os.path.join(workdir, option)), memory)
+	stages.append(["summary", len(mx), seconds, peak])
+
+	return stages
+
+
+def benchmark(nsamples, length, npositions, args):
+	""" benchmark the three input options for one dataset size
+	input: number of samples, alignment length, number of positions and arguments
+	output: dataframe """
+
+	rng = numpy.random.default_rng(args.seed)
+	results = []
+	with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+		alignment = os.path.join(workdir, "alignment.fasta")
+		reference = os.path.join(workdir, "reference.fasta")
+		ref_seq_nogaps = make_alignment(alignment, nsamples, length, args.gap_rate, args.mutation_rate, rng)
+		with open(reference, "wb") as out:
+			write_record(out, b"REF", numpy.frombuffer(ref_seq_nogaps.encode(), dtype=numpy.uint8))
+		files = make_mutations(workdir, ref_seq_nogaps, nsamples, npositions, max(args.before, args.after), rng)
+
+		for option in args.options.split(","):
+			fasta = reference if option == "OPTION2" else alignment
+			timing = run_option(option, fasta, files[option], workdir, args, False)
+			if args.memory:
+				peaks = [stage[3] for stage in run_option(option, fasta, files[option], workdir, args, True)]
+			else:
+				peaks = [None] * len(timing)
+			for (stage, rows, seconds, peak), peak_mb in zip(timing, peaks):
+				results.append({"option": option, "samples": nsamples, "genome_length": length, "positions": npositions, "threads": args.threads, "stage": stage, "rows": rows, "seconds": round(seconds, 4), "peak_memory_mb": None if peak_mb is None else round(peak_mb, 2)})
+
+	return pandas.DataFrame(results)
+
+
+# main	----------
+
+if __name__ == "__main__":
+
+	# argument options
+
+	parser = argparse.ArgumentParser(prog="benchmark_mutation_profile.py", formatter_class=argparse.RawDescriptionHelpFormatter, description=textwrap.dedent("""\
+									###############################################################################
+									#                                                                             #
+									#                       benchmark_mutation_profile.py                         #
+									#                                                                             #
+									###############################################################################
+
+									Generate synthetic alignments (with gaps in the reference), position lists
+									and ID/POS/REF/ALT tables of configurable size and measure the time and
+									the peak of memory of each stage of get_mutation_profile.py for the three
+									input options.
+
+									Comma-separated values in -n, -l and -p are combined to benchmark all the
+									dataset sizes, and the results are appended to a TSV file so that different
+									runs can be compared.
+									-----------------------------------------------------------------------------"""))
+
+	group0 = parser.add_argument_group("Synthetic data", "Size of the datasets")
+	group0.add_argument("-n", "--samples", dest="samples", type=str, default="100,1000", help="[OPTIONAL] Comma-separated list with the number of samples. Default = 100,1000")
+	group0.add_argument("-l", "--length", dest="length", type=str, default="30000", help="[OPTIONAL] Comma-separated list with the alignment length. Default = 30000")
+	group0.add_argument("-p", "--positions", dest="positions", type=str, default="100,1000", help="[OPTIONAL] Comma-separated list with the number of positions. Default = 100,1000")
+	group0.add_argument("--gap-rate", dest="gap_rate", type=float, default=0.01, help="[OPTIONAL] Proportion of gaps in the reference. Default = 0.01")
+	group0.add_argument("--mutation-rate", dest="mutation_rate", type=float, default=0.001, help="[OPTIONAL] Proportion of mutated positions per sample. Default = 0.001")
+	group0.add_argument("--seed", dest="seed", type=int, default=1, help="[OPTIONAL] Seed of the random generator. Default = 1")
+
+	group1 = parser.add_argument_group("Benchmark", "Parameters of get_mutation_profile.py and output")
+	group1.add_argument("--options", dest="options", type=str, default="OPTION1,OPTION2,OPTION3", help="[OPTIONAL] Comma-separated list of input options to benchmark. \
+						Default = OPTION1,OPTION2,OPTION3")
+	group1.add_argument("-b", "--before", dest="before", type=int, default=5, help="[OPTIONAL] Number of nucleotides to report BEFORE the mutation (default = 5)")
+	group1.add_argument("-a", "--after", dest="after", type=int, default=5, help="[OPTIONAL] Number of nucleotides to report AFTER the mutation (default = 5)")
+	group1.add_argument("--profiles", dest="profiles", type=str, default="GA>AA,TC>TT", help="[OPTIONAL] Comma-separated list of mutational profiles of interest. \
+						Default = 'GA>AA,TC>TT'")
+	group1.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=1000000, help="[OPTIONAL] Number of rows of the mutation list processed at once. Default = 1000000")
+	group1.add_argument("-t", "--threads", dest="threads", type=int, default=1, help="[OPTIONAL] Number of processes. Default = 1")
+	group1.add_argument("--no-memory", dest="memory", action="store_false", help="[OPTIONAL] Do not repeat the stages to measure the peak of memory (tracemalloc)")
+	group1.add_argument("--workdir", dest="workdir", type=str, default=None, help="[OPTIONAL] Directory for the temporary synthetic data. Default = system temporary directory")
+	group1.add_argument("-o", "--output", dest="output", type=str, default="benchmark_mutation_profile.tsv", help="[OPTIONAL] Output TSV file (results are appended). \
+						Default = benchmark_mutation_profile.tsv")
+
+	args = parser.parse_args()
+
+	date = datetime.datetime.now().isoformat(timespec="seconds")
+	sizes = itertools.product([int(v) for v in args.samples.split(",")], [int(v) for v in args.length.split(",")], [int(v) for v in args.positions.split(",")])
+
+	for nsamples, length, npositions in sizes:
+		print("Benchmarking " + str(nsamples) + " samples, " + str(length) + " alignment positions and " + str(npositions) + " positions of interest...")
+		results = benchmark(nsamples, length, npositions, args)
+		results.insert(0, "date", date)
+		results.to_csv(args.output, mode="a", index = False, header=not os.path.exists(args.output), sep ="\t")
+		for index, row in results.iterrows():
+			print("\t" + row["option"] + "\t" + row["stage"] + ": " + str(row["seconds"]) + " s" + ("" if pandas.isna(row["peak_memory_mb"]) else ", " + str(row["peak_memory_mb"]) + " MB"))
+
+	print("Done!")
@@ -9,221 +9,1241 @@ By Veronica Mixao
 
 import os
 import sys
+import re
+import gzip
+import shutil
+import hashlib
+import atexit
+import asyncio
+import functools
+import urllib.parse
+import tempfile
+import multiprocessing
 from shutil import which
 import argparse
 import textwrap
-from Bio import SeqIO, AlignIO
+import numpy
 import pandas
 
 
+# constants	----------
+
+UPPER_CASE = numpy.arange(256, dtype=numpy.uint8) # ASCII code -> upper-case ASCII code
+UPPER_CASE[ord("a"):ord("z") + 1] -= 32
+BLOCK_SIZE = 2**24 # maximum number of nucleotides read from the fasta file at once
+
+NUCL_CODE = numpy.full(256, 4, dtype=numpy.int64) # ASCII code -> A = 0, C = 1, G = 2, T = 3, other = 4
+for code, nucl in enumerate("ACGT"):
+	NUCL_CODE[ord(nucl)] = code
+	NUCL_CODE[ord(nucl.lower())] = code
+SBS96_SUBSTITUTION = numpy.array([[-1, -1, -1, -1], [0, -1, 1, 2], [-1, -1, -1, -1], [3, 4, 5, -1]]) # [ref][alt] -> C>A, C>G, C>T, T>A, T>C, T>G
+SBS96 = [five + "[" + sub + "]" + three for sub in ["C>A", "C>G", "C>T", "T>A", "T>C", "T>G"] for five in "ACGT" for three in "ACGT"]
+
+
 # functions	----------
 
+class RefCoords:
+	""" correspondence between reference and alignment positions stored in two arrays:
+	aln2ref[k] = number of reference nucleotides up to the alignment position k (1-based)
+	ref2aln[i] = alignment position of the reference position i (1-based)
+	It can also be used as a dictionary: coords[i] gives the alignment position of the reference 
+	position i and coords["i.j"] the one of the j-th gap after the reference position i """
+	
+	def __init__(self, seq):
+		nucl = numpy.frombuffer(str(seq).encode(), dtype=numpy.uint8) != ord("-")
+		dtype = numpy.int32 if len(nucl) < 2**31 else numpy.int64
+		self.aln2ref = numpy.zeros(len(nucl) + 1, dtype=dtype)
+		numpy.cumsum(nucl, dtype=dtype, out=self.aln2ref[1:])
+		self.ref2aln = numpy.zeros(int(self.aln2ref[-1]) + 1, dtype=dtype)
+		self.ref2aln[1:] = numpy.flatnonzero(nucl) + 1
+	
+	@classmethod
+	def from_arrays(cls, aln2ref, ref2aln):
+		coords = cls.__new__(cls)
+		coords.aln2ref = aln2ref
+		coords.ref2aln = ref2aln
+		return coords
+	
+	def __len__(self):
+		return len(self.aln2ref) - 1
+	
+	def __contains__(self, key):
+		try:
+			self[key]
+		except KeyError:
+			return False
+		return True
+	
+	def __getitem__(self, key):
+		if isinstance(key, str) and "." in key:
+			i, j = key.split(".", 1)
+			if int(j) < 1:
+				raise KeyError(key)
+			aln = self.to_aln([int(i)], [int(j)])
+		else:
+			aln = self.to_aln([key])
+		return int(aln[0])
+	
+	def to_aln(self, refpos, offset=0):
+		""" translate reference positions into alignment positions
+		input: array of 1-based reference positions (0 = before the first nucleotide) and 
+		optional array with the gap count after each of them
+		output: array of 1-based alignment positions """
+		
+		refpos = numpy.asarray(refpos, dtype=numpy.int64)
+		offset = numpy.broadcast_to(numpy.asarray(offset, dtype=numpy.int64), refpos.shape)
+		valid = (refpos >= (offset == 0)) & (refpos < len(self.ref2aln)) & (offset >= 0)
+		aln = numpy.where(valid, self.ref2aln[numpy.where(valid, refpos, 0)] + offset, 0)
+		valid &= aln < len(self.aln2ref)
+		valid &= self.aln2ref[numpy.where(valid, aln, 0)] == refpos # only gaps after the reference position
+		if not valid.all():
+			k = numpy.flatnonzero(~valid.ravel())[0]
+			p, o = int(refpos.ravel()[k]), int(offset.ravel()[k])
+			raise KeyError(p if o == 0 else str(p) + "." + str(o))
+		
+		return aln
+	
+	def to_ref(self, aln):
+		""" translate alignment positions into reference positions
+		input: array of 1-based alignment positions
+		output: arrays of 1-based reference positions and gap count after them """
+		
+		aln = numpy.asarray(aln, dtype=numpy.int64)
+		refpos = self.aln2ref[aln]
+		
+		return refpos, aln - self.ref2aln[refpos]
+
+
 def get_ref_coords(seq):
-	""" get a dictionary with d[alignment position] = reference position
-	input: alignment
-	output: dictionary coords[ref] = alignment
+	""" get the correspondence between reference and alignment positions
+	input: aligned reference sequence
+	output: RefCoords with coords[ref] = alignment
 	"""
 	
-	coords = {}
-	i = 0 # ref
-	j = 0 # del count
-	k = 0 # align
+	return RefCoords(seq)
 	
-	for nucl in seq:
-		k += 1
-		if nucl == "-":
-			if j == 0:
-				j = 1 # del count
-			else:
-				j += 1
-			code = str(i) + "." + str(j)
-			coords[code] = k
+	
+def ref2aln(coords, refpos):
+	""" translate reference positions into alignment positions
+	input: coordinates and array of 1-based reference positions
+	output: array of 1-based alignment positions with the same shape """
+	
+	try:
+		aln = coords.to_aln(refpos)
+	except KeyError as err:
+		print("Reference position " + str(err.args[0]) + " is outside the reference sequence!!! Cannot continue!")
+		sys.exit()
+	
+	return aln
+
+
+def window_columns(coords, positions, before, after):
+	""" get the alignment positions required to profile a list of reference positions
+	input: coordinates, 1-based reference positions and motif limits
+	output: sorted array of 0-based alignment positions """
+	
+	offsets = numpy.arange(min(-before, -1), max(after, 1) + 1) # motif and dinucleotide profiles
+	refpos = numpy.asarray(positions, dtype=numpy.int64)[:, None] + offsets
+	
+	return numpy.unique(ref2aln(coords, refpos)) - 1
+
+
+class FastaIndex:
+	""" byte offsets of the sequences in a fasta file (as in a samtools .fai index) used to read 
+	only the alignment positions of interest from the memory-mapped file """
+	
+	def __init__(self, filename):
+		self.filename = filename
+		fai = filename + ".fai"
+		if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(filename):
+			records = self.read_fai(fai)
 		else:
-			i += 1
-			j = 0
-			coords[i] = k
-			
-	return coords
+			records = self.scan(filename)
+		
+		self.ids = [record[0] for record in records]
+		self.lengths = numpy.array([record[1] for record in records], dtype=numpy.int64)
+		self.offsets = numpy.array([record[2] for record in records], dtype=numpy.int64)
+		self.linebases = numpy.array([max(record[3], 1) for record in records], dtype=numpy.int64)
+		self.linebytes = numpy.array([max(record[4], 1) for record in records], dtype=numpy.int64)
+		self.data = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+	
+	def __len__(self):
+		return len(self.ids)
+	
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["data"] # re-opened by each process instead of being copied
+		return state
+	
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.data = numpy.memmap(self.filename, dtype=numpy.uint8, mode="r")
+	
+	@staticmethod
+	def read_fai(fai):
+		""" read a samtools .fai index
+		input: fai file
+		output: list of [name, length, offset, line bases, line bytes] """
+		
+		records = []
+		with open(fai) as infile:
+			for line in infile:
+				l = line.rstrip("\n").split("\t")
+				records.append([l[0]] + [int(v) for v in l[1:5]])
+		
+		return records
+	
+	@staticmethod
+	def scan(filename):
+		""" get the byte offsets of each sequence in a fasta file
+		input: fasta file
+		output: list of [name, length, offset, line bases, line bytes] """
+		
+		records = []
+		record = None
+		last_line = False # a line shorter than the others was found in the current sequence
+		offset = 0
+		with open(filename, "rb") as infile:
+			for line in infile:
+				if line.startswith(b">"):
+					header = line[1:].split()
+					record = [header[0].decode() if header else "", 0, offset + len(line), 0, 0]
+					records.append(record)
+					last_line = False
+				elif record is not None:
+					bases = len(line.rstrip(b"\r\n"))
+					if record[3] == 0 and bases > 0: # first sequence line (blank lines may precede it)
+						record[2] = offset
+						record[3] = bases
+						record[4] = len(line)
+					elif bases > 0 and (last_line or bases > record[3]):
+						raise ValueError(filename + " does not have the same line length in all lines of " + record[0])
+					if bases < record[3] or len(line) != record[4]:
+						last_line = True
+					record[1] += bases
+				offset += len(line)
+		
+		return records
+	
+	def sequence(self, name):
+		""" read a full sequence
+		input: sequence name
+		output: upper-case sequence (or None if the name is not in the file) """
+		
+		if name not in self.ids:
+			return None
+		i = len(self.ids) - 1 - self.ids[::-1].index(name) # last sequence with this name
+		full_lines = int(self.lengths[i] // self.linebases[i])
+		end = self.offsets[i] + full_lines * self.linebytes[i] + self.lengths[i] % self.linebases[i]
+		raw = bytes(self.data[self.offsets[i]:end]).replace(b"\n", b"").replace(b"\r", b"")
+		
+		return raw.decode().upper()
+	
+	def columns(self, cols, rows=None):
+		""" read some positions of some of the sequences
+		input: 0-based positions and indexes of the sequences (default = all)
+		output: matrix (sequences x positions) of upper-case ASCII codes """
+		
+		cols = numpy.asarray(cols, dtype=numpy.int64)
+		rows = numpy.arange(len(self.ids)) if rows is None else numpy.asarray(rows, dtype=numpy.int64)
+		block = numpy.empty((len(rows), len(cols)), dtype=numpy.uint8)
+		step = max(1, BLOCK_SIZE // max(len(cols), 1))
+		for start in range(0, len(rows), step):
+			r = rows[start:start + step, None]
+			if len(cols) > 0 and (cols.max() >= self.lengths[r]).any():
+				raise IndexError("Position outside the sequences of " + self.filename)
+			offsets = self.offsets[r] + cols // self.linebases[r] * self.linebytes[r] + cols % self.linebases[r]
+			block[start:start + step] = UPPER_CASE[self.data[offsets]]
+		
+		return block
+
+
+def flatten_fasta(filename):
+	""" write an uncompressed copy of a fasta file with one line per sequence
+	input: fasta file (can be gzipped)
+	output: temporary fasta file """
+	
+	handle, tmpname = tempfile.mkstemp(suffix=".fasta")
+	atexit.register(os.remove, tmpname)
+	
+	opener = gzip.open if is_gzipped(filename) else open
+	
+	with opener(filename, "rb") as infile, os.fdopen(handle, "wb") as out:
+		in_seq = False
+		for line in infile:
+			if line.startswith(b">"):
+				if in_seq:
+					out.write(b"\n")
+				out.write(line.rstrip(b"\r\n") + b"\n")
+				in_seq = False
+			else:
+				seq = line.rstrip(b"\r\n")
+				out.write(seq)
+				in_seq = in_seq or len(seq) > 0
+		if in_seq:
+			out.write(b"\n")
+	
+	return tmpname
+
+
+def load_fasta(filename):
+	""" index a fasta file, using an unwrapped copy when it is compressed or irregularly wrapped
+	input: fasta file
+	output: FastaIndex """
+	
+	if not is_gzipped(filename):
+		try:
+			return FastaIndex(filename)
+		except ValueError as err:
+			print("\t" + str(err))
+	print("\tWriting an uncompressed copy of the fasta file with one line per sequence...")
+	
+	return FastaIndex(flatten_fasta(filename))
+
+
+class AlignmentCache:
+	""" alignment stored in a cache directory as a matrix (alignment positions x sequences) of 
+	upper-case ASCII codes, together with the sequence names, the reference sequence and its 
+	coordinate map, all opened with mmap """
+	
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, "ids.txt")) as infile:
+			self.ids = infile.read().splitlines()
+		with open(os.path.join(path, "reference.txt")) as infile:
+			self.ref, self.ref_seq = infile.read().splitlines()
+		self.matrix = numpy.load(os.path.join(path, "matrix.npy"), mmap_mode="r")
+		self.lengths = numpy.full(len(self.ids), self.matrix.shape[0], dtype=numpy.int64)
+		self.coords = RefCoords.from_arrays(numpy.load(os.path.join(path, "aln2ref.npy"), mmap_mode="r"), numpy.load(os.path.join(path, "ref2aln.npy"), mmap_mode="r"))
+	
+	def __len__(self):
+		return len(self.ids)
+	
+	def __getstate__(self):
+		return self.path
+	
+	def __setstate__(self, path):
+		self.__init__(path)
+	
+	def sequence(self, name):
+		""" read a full sequence
+		input: sequence name
+		output: upper-case sequence (or None if the name is not in the cache) """
+		
+		if name == self.ref:
+			return self.ref_seq
+		if name not in self.ids:
+			return None
+		i = len(self.ids) - 1 - self.ids[::-1].index(name)
+		
+		return self.matrix[:, i].tobytes().decode()
+	
+	def columns(self, cols, rows=None):
+		""" read some positions of some of the sequences
+		input: 0-based positions and indexes of the sequences (default = all)
+		output: matrix (sequences x positions) of upper-case ASCII codes """
+		
+		block = self.matrix[numpy.asarray(cols, dtype=numpy.int64)]
+		if rows is not None:
+			block = block[:, numpy.asarray(rows, dtype=numpy.int64)]
+		
+		return numpy.ascontiguousarray(block.T)
+
+
+class ColumnBlock:
+	""" some alignment positions of all the sequences of a FastaIndex or AlignmentCache, read once 
+	to be shared by several mutation lists """
+	
+	def __init__(self, sequences, cols):
+		self.sequences = sequences
+		self.ids = sequences.ids
+		self.lengths = sequences.lengths
+		self.cols = numpy.asarray(cols, dtype=numpy.int64)
+		self.block = sequences.columns(self.cols)
+	
+	def __len__(self):
+		return len(self.ids)
+	
+	def sequence(self, name):
+		return self.sequences.sequence(name)
+	
+	def columns(self, cols, rows=None):
+		""" read some of the preloaded positions of some of the sequences
+		input: 0-based positions and indexes of the sequences (default = all)
+		output: matrix (sequences x positions) of upper-case ASCII codes """
+		
+		block = self.block if rows is None else self.block[numpy.asarray(rows, dtype=numpy.int64)]
+		
+		return block[:, numpy.searchsorted(self.cols, cols)]
+
+
+def file_hash(filename):
+	""" get the checksum of the content of a file
+	input: file
+	output: hexadecimal digest """
+	
+	digest = hashlib.blake2b(digest_size=16)
+	with open(filename, "rb") as infile:
+		for block in iter(lambda: infile.read(2**24), b""):
+			digest.update(block)
+	
+	return digest.hexdigest()
+
+
+def build_cache(sequences, ref, ref_seq, coords, path):
+	""" write an alignment to a cache directory
+	input: FastaIndex, reference name and sequence, coordinates and cache directory """
+	
+	tmp = path + ".tmp" + str(os.getpid())
+	os.makedirs(tmp)
+	
+	length = int(sequences.lengths[0])
+	matrix = numpy.lib.format.open_memmap(os.path.join(tmp, "matrix.npy"), mode="w+", dtype=numpy.uint8, shape=(length, len(sequences)))
+	step = max(1, BLOCK_SIZE // max(len(sequences), 1)) # blocks of contiguous positions (rows of the matrix)
+	for start in range(0, length, step):
+		end = min(start + step, length)
+		matrix[start:end] = sequences.columns(numpy.arange(start, end)).T
+	matrix.flush()
+	del matrix
+	
+	with open(os.path.join(tmp, "ids.txt"), "w") as out:
+		print("\n".join(sequences.ids), file = out)
+	with open(os.path.join(tmp, "reference.txt"), "w") as out:
+		print(ref + "\n" + ref_seq, file = out)
+	numpy.save(os.path.join(tmp, "aln2ref.npy"), coords.aln2ref)
+	numpy.save(os.path.join(tmp, "ref2aln.npy"), coords.ref2aln)
+	
+	try:
+		os.rename(tmp, path)
+	except OSError: # built at the same time by another run
+		shutil.rmtree(tmp)
+
+
+def evict_cache(cache_dir, max_size, keep):
+	""" remove the least recently used caches until the cache directory is below a size limit
+	input: cache directory, maximum size (bytes) and cache that must be kept """
+	
+	entries = []
+	for entry in os.scandir(cache_dir):
+		if entry.is_dir() and ".tmp" not in entry.name:
+			size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+			entries.append((entry.stat().st_mtime, size, entry.path))
+	
+	total = sum(size for mtime, size, path in entries)
+	for mtime, size, path in sorted(entries):
+		if total <= max_size:
+			break
+		if path != keep:
+			print("\tRemoving old alignment cache " + path)
+			shutil.rmtree(path, ignore_errors=True)
+			total -= size
+
+
+def open_cache(filename, ref, cache_dir, max_size):
+	""" open the cache of an alignment, (re)building it when the content of the fasta file changes
+	input: fasta file, reference name, cache directory and its maximum size (bytes)
+	output: AlignmentCache (or FastaIndex if the alignment cannot be cached) """
+	
+	os.makedirs(cache_dir, exist_ok=True)
+	info = os.stat(filename)
+	source = "\t".join([os.path.realpath(filename), str(info.st_size), str(info.st_mtime_ns), ref])
+	
+	path = None
+	for entry in os.scandir(cache_dir):
+		if entry.is_dir() and os.path.exists(os.path.join(entry.path, "source.tsv")):
+			with open(os.path.join(entry.path, "source.tsv")) as infile:
+				if infile.read().rstrip("\n") == source:
+					path = entry.path
+					break
+	
+	if path is None:
+		print("\tComputing the checksum of the fasta file...")
+		path = os.path.join(cache_dir, file_hash(filename) + "_" + re.sub(r"[^\w.-]", "_", ref))
+		if not os.path.exists(path):
+			print("\tBuilding the alignment cache in " + path + "...")
+			sequences = load_fasta(filename)
+			ref_seq = sequences.sequence(ref)
+			if ref_seq is None or len(set(sequences.lengths.tolist())) > 1:
+				print("\tThe fasta file is not an alignment including the reference and cannot be cached.")
+				return sequences
+			build_cache(sequences, ref, ref_seq, get_ref_coords(ref_seq), path)
+		with open(os.path.join(path, "source.tsv"), "w") as out:
+			print(source, file = out)
+	
+	os.utime(path)
+	evict_cache(cache_dir, max_size, path)
+	
+	return AlignmentCache(path)
+
+
+def matrix2strings(matrix):
+	""" join the last axis of a matrix of ASCII codes into byte strings
+	input: matrix
+	output: array of byte strings """
+	
+	matrix = numpy.ascontiguousarray(matrix, dtype=numpy.uint8)
+	
+	return matrix.view("S" + str(matrix.shape[-1]))[..., 0]
+
+
+def alignment_profile(ids, block, columns, ref, ref_seq_nogaps, coords, positions, before, after, profiles):
+	""" obtain the mutation profile of every sample of an alignment with array operations
+	input: sequence names, matrix with the alignment positions of interest (sequences x columns), 
+	0-based alignment position of each column, reference name and ungapped sequence, coordinates, 
+	1-based reference positions, motif limits and profiles of interest
+	output: dictionary with one array (positions x samples) per output column """
+	
+	keep = numpy.array([sample != ref for sample in ids], dtype=bool)
+	samples = numpy.array(ids, dtype=object)[keep]
+	block = block[keep]
+	pos = numpy.asarray(positions, dtype=numpy.int64)
+	shape = (len(pos), len(samples))
+	ref_nucl = numpy.frombuffer(ref_seq_nogaps.encode(), dtype=numpy.uint8)
+	
+	# reference positions -> columns of the block
+	window = pos[:, None] + numpy.arange(-before, after + 1)
+	flank = pos[:, None] + numpy.arange(-1, 2) # pos-1, pos, pos+1
+	window_cols = numpy.searchsorted(columns, ref2aln(coords, window) - 1)
+	flank_cols = numpy.searchsorted(columns, ref2aln(coords, flank) - 1)
+	
+	motif_sample = block[:, window_cols].transpose(1, 0, 2) # positions x samples x motif
+	flank_sample = block[:, flank_cols].transpose(1, 0, 2) # positions x samples x 3
+	flank_ref = ref_nucl[flank - 1][:, None, :]
+	
+	# "XY>XY or YZ>YZ"
+	observed = numpy.empty(shape + (14,), dtype=numpy.uint8)
+	observed[:] = numpy.frombuffer(b"..>.. or ..>..", dtype=numpy.uint8)
+	observed[:, :, 0:2] = flank_ref[:, :, 0:2]
+	observed[:, :, 3:5] = flank_sample[:, :, 0:2]
+	observed[:, :, 9:11] = flank_ref[:, :, 1:3]
+	observed[:, :, 12:14] = flank_sample[:, :, 1:3]
+	
+	prof = numpy.array([p.encode() for p in profiles.split(",") if len(p.encode()) == 5], dtype="S5")
+	observed_profile = matrix2strings(observed)
+	profile1 = matrix2strings(observed[:, :, 0:5])
+	profile2 = matrix2strings(observed[:, :, 9:14])
+	is_profile1 = numpy.isin(profile1, prof)
+	is_profile2 = numpy.isin(profile2, prof)
+	interest = numpy.where(is_profile1 & is_profile2, observed_profile, numpy.where(is_profile1, profile1, numpy.where(is_profile2, profile2, b"other")))
+	
+	info = {"sample": numpy.broadcast_to(samples, shape),
+		"ref_position": numpy.broadcast_to(numpy.asarray(positions)[:, None], shape),
+		"ref": numpy.broadcast_to(matrix2strings(flank_ref[:, :, 1:2]), shape).astype(str),
+		"alt": matrix2strings(flank_sample[:, :, 1:2]).astype(str),
+		"motif_ref": numpy.broadcast_to(matrix2strings(ref_nucl[window - 1])[:, None], shape).astype(str),
+		"motif_sample": matrix2strings(motif_sample).astype(str),
+		"observed_profile": observed_profile.astype(str),
+		"profile_of_interest": interest.astype(str)}
+	
+	return info
+
+
+def check_window(positions, before, after, length):
+	""" stop if the motif window of a position falls outside the reference sequence
+	input: 1-based reference positions, motif limits and reference length """
+	
+	if len(positions) == 0:
+		return
+	first = int(numpy.min(positions)) - max(before, 1)
+	last = int(numpy.max(positions)) + max(after, 1)
+	if first < 1 or last > length:
+		print("Reference position " + str(first if first < 1 else last) + " is outside the reference sequence!!! Cannot continue!")
+		sys.exit()
+
+
+def join_strings(*arrays):
+	""" concatenate arrays of strings element-wise
+	input: arrays or strings
+	output: array of strings """
+	
+	joint = arrays[0]
+	for array in arrays[1:]:
+		joint = numpy.char.add(joint, array)
+	
+	return joint
+
+
+def table_profile(mutation_df, ref_seq_nogaps, before, after, profiles):
+	""" obtain the mutation profile of a table with the columns (ID) POS REF ALT
+	input: mutations, ungapped reference sequence, motif limits and profiles of interest
+	output: dataframe """
+	
+	prof = numpy.array(profiles.split(","), dtype=str)
+	ref_nucl = numpy.frombuffer(ref_seq_nogaps.encode(), dtype=numpy.uint8)
+	pos = mutation_df["POS"].to_numpy().astype(numpy.int64)
+	alt = mutation_df["ALT"].astype(str).to_numpy(dtype=str)
+	
+	window = pos[:, None] + numpy.arange(-before, after + 1)
+	flank = ref_nucl[pos[:, None] + numpy.arange(-2, 1)] # pos-1, pos, pos+1
+	previous = matrix2strings(flank[:, 0:1]).astype(str)
+	following = matrix2strings(flank[:, 2:3]).astype(str)
+	
+	profile1 = join_strings(matrix2strings(flank[:, 0:2]).astype(str), ">", previous, alt)
+	profile2 = join_strings(matrix2strings(flank[:, 1:3]).astype(str), ">", alt, following)
+	is_profile1 = numpy.isin(profile1, prof)
+	is_profile2 = numpy.isin(profile2, prof)
+	observed_profile = join_strings(profile1, " or ", profile2)
+	
+	info = {}
+	if "ID" in mutation_df.columns:
+		info["sample"] = mutation_df[mutation_df.columns[0]].values
+	info["ref_position"] = mutation_df["POS"].values
+	info["ref"] = mutation_df["REF"].values
+	info["alt"] = mutation_df["ALT"].values
+	info["motif_ref"] = matrix2strings(ref_nucl[window - 1]).astype(str)
+	info["observed_profile"] = observed_profile
+	info["profile_of_interest"] = numpy.where(is_profile1 & is_profile2, observed_profile, numpy.where(is_profile1, profile1, numpy.where(is_profile2, profile2, "other")))
+	
+	for col in mutation_df.columns:
+		if col != "POS" and col != "REF" and col != "ALT" and col != "ID":
+			if col not in info.keys():
+				info[col] = mutation_df[col].values
+	
+	return pandas.DataFrame(info)
+
+
+def is_gzipped(filename):
+	""" check if a file is gzip (or bgzip) compressed """
+	
+	with open(filename, "rb") as infile:
+		return infile.read(2) == b"\x1f\x8b"
+
+
+def is_vcf(filename):
+	""" check if a file is in VCF format """
+	
+	opener = gzip.open if is_gzipped(filename) else open
+	with opener(filename, "rt") as infile:
+		return infile.readline().startswith("##fileformat=VCF")
+
+
+def vcf2mutations(chunk, samples):
+	""" convert VCF records into a table of mutations, with one row per alternative allele 
+	(or per sample and alternative allele found in its genotype)
+	input: dataframe with VCF records and list of sample names
+	output: dataframe with the columns (ID) POS REF ALT """
+	
+	alts = chunk["ALT"].str.split(",").explode().to_frame("ALT")
+	alts["allele"] = alts.groupby(level=0).cumcount() + 1
+	alts = alts.rename_axis("row").reset_index()
+	alts = alts[~alts["ALT"].isin([".", "*"])]
+	
+	if len(samples) == 0:
+		calls = alts
+	else:
+		gt = pandas.DataFrame({sample: chunk[sample].str.split(":", n=1).str[0] for sample in samples}, index=chunk.index)
+		gt = gt.rename_axis(index="row", columns="ID").stack()
+		alleles = pandas.to_numeric(gt.str.split(r"[/|]", regex=True).explode(), errors="coerce")
+		calls = alleles[alleles > 0].astype(int).to_frame("allele").reset_index()
+		calls = calls.drop_duplicates().merge(alts, on=["row", "allele"], how="inner")
+	
+	mutations = pandas.DataFrame({"POS": chunk.loc[calls["row"], "POS"].values, "REF": chunk.loc[calls["row"], "REF"].values, "ALT": calls["ALT"].values})
+	if len(samples) > 0:
+		mutations.insert(0, "ID", calls["ID"].values)
+	
+	return mutations
+
+
+def read_vcf(filename, chunksize):
+	""" read a (b)gzipped or plain VCF file in chunks
+	input: VCF file and number of records per chunk
+	output: iterator of dataframes with the columns (ID) POS REF ALT """
+	
+	opener = gzip.open if is_gzipped(filename) else open
+	with opener(filename, "rt") as infile:
+		line = infile.readline()
+		while line.startswith("##"):
+			line = infile.readline()
+		header = line.lstrip("#").rstrip("\r\n").split("\t")
+		samples = header[9:]
+		for chunk in pandas.read_table(infile, header=None, names=header, dtype=str, chunksize=chunksize):
+			yield vcf2mutations(chunk, samples)
+
+
+def read_mutations(filename, chunksize):
+	""" read a table of mutations with the columns (ID) POS REF ALT or a VCF file in chunks
+	input: mutation list and number of rows per chunk
+	output: iterator of dataframes """
+	
+	if is_vcf(filename):
+		return read_vcf(filename, chunksize)
+	
+	return pandas.read_table(filename, dtype=str, chunksize=chunksize)
+
+
+def read_positions(filename):
+	""" read a list of positions (OPTION1) at once
+	input: mutation list
+	output: dataframe (None if the list has the columns POS, REF and ALT or is a VCF) """
+	
+	if is_vcf(filename):
+		return None
+	columns = pandas.read_table(filename, nrows=0).columns
+	if "POS" in columns and "REF" in columns and "ALT" in columns:
+		return None
+	
+	return pandas.read_table(filename)
+
+
+def read_manifest(filename, before, after, profiles):
+	""" read the jobs of the batch mode
+	input: TSV with the columns mutation_list and output (and optionally profiles, before and after), 
+	and the values used when these are not provided
+	output: list of dictionaries """
+	
+	manifest = pandas.read_table(filename, dtype=str)
+	if "mutation_list" not in manifest.columns or "output" not in manifest.columns:
+		print("The batch file must have the columns 'mutation_list' and 'output'! Cannot continue!!!")
+		sys.exit()
+	
+	jobs = []
+	for index, row in manifest.iterrows():
+		job = {"mutation": row["mutation_list"], "output": row["output"], "profiles": profiles, "before": before, "after": after}
+		for col in ["profiles", "before", "after"]:
+			if col in manifest.columns and not pandas.isna(row[col]):
+				job[col] = row[col] if col == "profiles" else int(row[col])
+		jobs.append(job)
+	
+	return jobs
+
+
+class RepeatIndex:
+	""" sorted index of the repeat regions of a BED file (e.g. Final.bed of polybed.py), split in 
+	disjoint segments with the classes overlapping each one """
+	
+	def __init__(self, filename):
+		bed = pandas.read_table(filename, header=None, dtype=str, comment="#")
+		bed = bed[~bed[0].str.startswith(("track", "browser"))]
+		starts = bed[1].astype(int).values
+		ends = bed[2].astype(int).values
+		classes = bed[3].values if bed.shape[1] > 3 else numpy.full(len(bed), "repeat")
+		
+		# sweep over the interval limits keeping the classes open in each segment
+		events = sorted([(s, 1, c) for s, c in zip(starts, classes)] + [(e, -1, c) for e, c in zip(ends, classes)])
+		self.bounds = []
+		self.labels = []
+		active = {}
+		for pos, step, cl in events:
+			if len(self.bounds) == 0 or self.bounds[-1] != pos:
+				self.bounds.append(pos)
+				self.labels.append("")
+			active[cl] = active.get(cl, 0) + step
+			if active[cl] == 0:
+				del active[cl]
+			self.labels[-1] = ",".join(sorted(active))
+		self.bounds = numpy.array(self.bounds, dtype=numpy.int64)
+		self.labels = numpy.array(self.labels + [""], dtype=object)
+		self.intervals = len(bed)
+	
+	def lookup(self, positions):
+		""" get the repeat classes of 1-based reference positions
+		input: array of positions
+		output: array with the comma-separated classes ("" outside repeats) """
+		
+		idx = numpy.searchsorted(self.bounds, numpy.asarray(positions, dtype=numpy.int64) - 1, side="right") - 1
+		return self.labels[idx] # idx = -1 (before the first interval) is the last label ("")
+
+
+def annotate_repeats(mx, repeats):
+	""" add the columns in_repeat and repeat_class to a dataframe of mutation profiles
+	input: pandas matrix and RepeatIndex """
+	
+	classes = repeats.lookup(pandas.to_numeric(mx["ref_position"]).values)
+	mx["in_repeat"] = classes != ""
+	mx["repeat_class"] = numpy.where(classes != "", classes, "-")
+
+
+SHARED = {} # data shared by all the tasks of a worker process
+
+
+def shared_data(sequences, before, after, ref, ref_seq, coords, profiles):
+	""" gather the data needed by every task of a mutation profile
+	input: fasta, motif limits, reference name and sequence, coordinates and profiles of interest
+	output: dictionary """
+	
+	return {"sequences": sequences, "before": before, "after": after, "ref": ref, "ref_seq_nogaps": str(ref_seq).replace("-", ""), "coords": coords, "profiles": profiles}
+
+
+def init_worker(shared):
+	""" keep the data shared by all the tasks of a worker process
+	input: dictionary """
 	
+	SHARED.update(shared)
+
+
+def profile_pool(shared, threads):
+	""" start a pool of processes that keep the data shared by the tasks of a mutation profile
+	input: dictionary from shared_data and number of processes
+	output: multiprocessing pool (None for a single process) """
 	
-def mut_profile(sequences, before, after, ref, ref_seq, coords, profiles, mutation_df):
+	if threads <= 1:
+		return None
+	
+	return multiprocessing.Pool(threads, initializer=init_worker, initargs=(shared,))
+
+
+def alignment_shard(task):
+	""" obtain the mutation profile of some sequences of the alignment in SHARED
+	input: indexes of the sequences, 1-based reference positions and 0-based alignment positions to read
+	output: dictionary with one array (positions x samples) per output column """
+	
+	rows, positions, columns = task
+	sequences = SHARED["sequences"]
+	ids = [sequences.ids[r] for r in rows]
+	block = sequences.columns(columns, rows)
+	
+	return alignment_profile(ids, block, columns, SHARED["ref"], SHARED["ref_seq_nogaps"], SHARED["coords"], positions, SHARED["before"], SHARED["after"], SHARED["profiles"])
+
+
+def table_shard(mutation_df):
+	""" obtain the mutation profile of some rows of a table of mutations
+	input: dataframe
+	output: dataframe """
+	
+	return table_profile(mutation_df, SHARED["ref_seq_nogaps"], SHARED["before"], SHARED["after"], SHARED["profiles"])
+
+
+def run_shards(function, shards, shared, threads, pool=None):
+	""" run a function over shards of data in a pool of processes, keeping the order of the shards
+	input: function, list of shards, data shared by all the shards, number of processes and 
+	pool from profile_pool (if not provided, a new one is started)
+	output: list of results """
+	
+	if threads <= 1 or len(shards) <= 1:
+		init_worker(shared)
+		return [function(shard) for shard in shards]
+	
+	if pool is not None:
+		return pool.map(function, shards)
+	with profile_pool(shared, min(threads, len(shards))) as pool:
+		return pool.map(function, shards)
+
+
+def mut_profile(sequences, before, after, ref, ref_seq, coords, profiles, mutation_df, threads=1, pool=None):
 	""" obtain a dataframe with a summary of the mutation profile
-	input: fasta and mutations
+	input: fasta, mutations, number of processes and pool from profile_pool
 	output: dataframe """
 	
-	prof = profiles.split(",")
-	ref_seq_nogaps = ref_seq.ungap("-")
+	shared = shared_data(sequences, before, after, ref, ref_seq, coords, profiles)
+	ref_seq_nogaps = shared["ref_seq_nogaps"]
+	nshards = threads * 4 if threads > 1 else 1
 	
 	if "POS" in mutation_df.columns and "ALT" in mutation_df.columns and "REF" in mutation_df.columns:
-		mutations = mutation_df["POS"].values.tolist()
-		ref_nucl = mutation_df["REF"].values.tolist()
-		alt_nucl = mutation_df["ALT"].values.tolist()
-		if "ID" in mutation_df.columns:
-			samples = mutation_df[mutation_df.columns[0]].values.tolist()
-			info = {"sample": samples, "ref_position": mutations, "ref": ref_nucl, "alt": alt_nucl, "motif_ref": [], "observed_profile": [],  "profile_of_interest": []}
-		else:
-			info = {"ref_position": mutations, "ref": ref_nucl, "alt": alt_nucl, "motif_ref": [], "observed_profile": [],  "profile_of_interest": []}
-		
-		for index, row in mutation_df.iterrows():
-			pos = int(row["POS"])
-			pos_0 = pos - 1
-			ref_motif = ""
-			for p in range(int(pos) - int(before), int(pos) + (int(after) + 1)):
-				ref_motif += ref_seq_nogaps[p-1]
-			info["motif_ref"].append(ref_motif)
-				
-			profile1_REF = str(ref_seq_nogaps[pos-2]) + str(ref_seq_nogaps[pos-1])
-			profile1_SEQ = str(ref_seq_nogaps[pos-2]) + str(row["ALT"])
-			profile1 = profile1_REF + ">" + profile1_SEQ
-		
-			profile2_REF = str(ref_seq_nogaps[pos-1]) + str(ref_seq_nogaps[pos])
-			profile2_SEQ = str(row["ALT"]) + str(ref_seq_nogaps[pos])
-			profile2 = profile2_REF + ">" + profile2_SEQ
-				
-			info["observed_profile"].append(profile1 + " or " + profile2)
-				
-			profile_of_interest = []
-			if profile1 in prof:
-				profile_of_interest.append(profile1)
-			if profile2 in prof:
-				profile_of_interest.append(profile2)
-				
-			if len(profile_of_interest) == 0:
-				info["profile_of_interest"].append("other")
-			else:
-				info["profile_of_interest"].append(" or ".join(profile_of_interest))
-		
-		for col in mutation_df.columns:
-			if col != "POS" and col != "REF" and col != "ALT" and col != "ID":
-				if col not in info.keys():
-					info[col] = mutation_df[col].values.tolist()
+		check_window(mutation_df["POS"].to_numpy().astype(numpy.int64), before, after, len(ref_seq_nogaps))
+		shards = [mutation_df.iloc[rows] for rows in numpy.array_split(numpy.arange(len(mutation_df)), nshards) if len(rows) > 0]
+		if len(shards) == 0:
+			return table_profile(mutation_df, ref_seq_nogaps, before, after, profiles)
+		df = pandas.concat(run_shards(table_shard, shards, shared, threads, pool), ignore_index=True)
+	
 	else:
 		if len(sequences) == 1: # alignment was not provided
 			print("Only 1 sequence provided and I cannot find alternative alleles in the mutation list! Cannot continue!!!")
 			sys.exit()
 		else: 
+			if len(set(sequences.lengths.tolist())) > 1:
+				print("The sequences in the fasta file do not have the same length! Cannot continue!!!")
+				sys.exit()
 			positions = mutation_df[mutation_df.columns[0]].values.tolist()
-			info = {"sample": [], "ref_position": [], "ref": [], "alt": [], "motif_ref": [], "motif_sample": [], "observed_profile": [],  "profile_of_interest": []}
-			
-			for pos in positions:
-				pos_0 = int(coords[pos]) - 1
-				for record in sequences:
-					if record.id != ref:
-						seq = record.seq.upper()
-						info["sample"].append(record.id)
-						info["ref_position"].append(pos)
-						info["ref"].append(ref_seq[pos_0])
-						info["alt"].append(seq[pos_0])
-				
-						ref_motif = ""
-						seq_motif = ""
-						for p in range(int(pos) - int(before), int(pos) + (int(after) + 1)):
-							ref_motif += ref_seq_nogaps[p-1]
-							seq_motif += seq[int(coords[p])-1]
-						info["motif_ref"].append(ref_motif)
-						info["motif_sample"].append(seq_motif)
-				
-						profile1_REF = str(ref_seq_nogaps[pos-2]) + str(ref_seq_nogaps[pos-1])
-						profile1_SEQ = str(seq[int(coords[pos-1])-1]) + str(seq[int(coords[pos])-1])
-						profile1 = profile1_REF + ">" + profile1_SEQ
-		
-						profile2_REF = str(ref_seq_nogaps[pos-1]) + str(ref_seq_nogaps[pos])
-						profile2_SEQ = str(seq[int(coords[pos])-1]) + str(seq[int(coords[pos+1])-1])
-						profile2 = profile2_REF + ">" + profile2_SEQ
-				
-						info["observed_profile"].append(profile1 + " or " + profile2)
-				
-						profile_of_interest = []
-						if profile1 in prof:
-							profile_of_interest.append(profile1)
-						if profile2 in prof:
-							profile_of_interest.append(profile2)
-				
-						if len(profile_of_interest) == 0:
-							info["profile_of_interest"].append("other")
-						else:
-							info["profile_of_interest"].append(" or ".join(profile_of_interest))
-			
-	df = pandas.DataFrame(info)
+			columns = window_columns(coords, positions, before, after)
+			shards = [(rows, positions, columns) for rows in numpy.array_split(numpy.arange(len(sequences)), nshards) if len(rows) > 0]
+			parts = run_shards(alignment_shard, shards, shared, threads, pool)
+			info = {col: numpy.concatenate([part[col] for part in parts], axis=1).ravel() for col in parts[0]}
+			df = pandas.DataFrame(info)
 	
 	return df
 
 
+class TableWriter:
+	""" buffered writer of a tab-separated table that receives its rows in batches 
+	(gzip compressed if the file name ends with .gz) """
+	
+	def __init__(self, filename):
+		if filename.endswith(".gz"):
+			self.handle = gzip.open(filename, "wt", compresslevel=6)
+		else:
+			self.handle = open(filename, "w", buffering=2**20)
+		self.header = True
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc):
+		self.close()
+	
+	def write(self, df):
+		df.to_csv(self.handle, index = False, header=self.header, sep ="\t")
+		self.header = False
+	
+	def close(self):
+		self.handle.close()
+
+
+def sbs96_channels(mx, ref_seq_nogaps):
+	""" get the SBS-96 channel of each mutation from the reference trinucleotide context, with 
+	purine reference alleles converted to their reverse complement
+	input: dataframe with the mutation profiles and ungapped reference sequence
+	output: array with the channel index (0-95 as in SBS96) or -1 if it is not a single base substitution """
+	
+	ref_code = NUCL_CODE[numpy.frombuffer(ref_seq_nogaps.encode(), dtype=numpy.uint8)]
+	pos = mx["ref_position"].to_numpy().astype(numpy.int64)
+	alt = mx["alt"].astype(str)
+	alt_code = NUCL_CODE[alt.where(alt.str.len() == 1, "N").to_numpy(dtype="S1").view(numpy.uint8)]
+	five, ref, three = ref_code[pos - 2], ref_code[pos - 1], ref_code[pos]
+	
+	valid = (five < 4) & (ref < 4) & (alt_code < 4) & (three < 4) & (ref != alt_code)
+	purine = (ref == 0) | (ref == 2)
+	ref, alt_code, five, three = numpy.where(purine, 3 - ref, ref), numpy.where(purine, 3 - alt_code, alt_code), numpy.where(purine, 3 - three, five), numpy.where(purine, 3 - five, three)
+	substitution = SBS96_SUBSTITUTION[numpy.where(valid, ref, 0), numpy.where(valid, alt_code, 0)]
+	
+	return numpy.where(valid, substitution * 16 + five * 4 + three, -1)
+
+
+class SignatureCounts:
+	""" running SBS-96 counts per sample """
+	
+	def __init__(self):
+		self.samples = {} # sample -> row
+		self.counts = numpy.zeros((0, len(SBS96)), dtype=numpy.int64)
+	
+	def update(self, samples, channels):
+		""" add the mutations of some samples
+		input: array with the sample of each mutation and array with its SBS-96 channel """
+		
+		codes, names = pandas.factorize(numpy.asarray(samples))
+		rows = numpy.array([self.samples.setdefault(name, len(self.samples)) for name in names], dtype=numpy.int64)
+		if len(self.samples) > len(self.counts):
+			self.counts = numpy.vstack([self.counts, numpy.zeros((len(self.samples) - len(self.counts), len(SBS96)), dtype=numpy.int64)])
+		
+		keep = channels >= 0
+		self.counts += numpy.bincount(rows[codes[keep]] * len(SBS96) + channels[keep], minlength=self.counts.size).reshape(self.counts.shape)
+	
+	def write(self, filename):
+		""" write the count matrix with one row per channel and one column per sample
+		input: output file name """
+		
+		df = pandas.DataFrame(self.counts.T, index=pandas.Index(SBS96, name="MutationType"), columns=list(self.samples))
+		df.to_csv(filename, index = True, header=True, sep ="\t")
+
+
+def alignment_batches(mutation_df, nsequences, chunksize):
+	""" split a list of positions (OPTION1) so that each batch produces about chunksize rows
+	input: dataframe, number of sequences in the alignment and number of rows per batch
+	output: iterator of dataframes """
+	
+	step = max(1, chunksize // max(nsequences - 1, 1))
+	for start in range(0, len(mutation_df), step):
+		yield mutation_df.iloc[start:start + step]
+
+
+def write_profiles(mutations, sequences, before, after, ref, ref_seq, coords, profiles, out, threads=1, pool=None, signature=None, compress=False, repeats=None):
+	""" obtain the mutation profile of each batch of mutations and write it as soon as it is computed
+	input: iterator of dataframes, fasta, motif limits, reference name and sequence, coordinates, 
+	profiles of interest, output tag, number of processes, pool from profile_pool, SignatureCounts 
+	(or None), whether the table should be gzipped and RepeatIndex (or None)
+	output: tsv file and ProfileSummary """
+	
+	counts = ProfileSummary()
+	ref_seq_nogaps = str(ref_seq).replace("-", "")
+	with TableWriter(out + ".tsv" + (".gz" if compress else "")) as writer:
+		for mutation_df in mutations:
+			mx = mut_profile(sequences, before, after, ref, ref_seq, coords, profiles, mutation_df, threads, pool)
+			if signature is not None:
+				channels = sbs96_channels(mx, ref_seq_nogaps)
+				mx["sbs96"] = numpy.where(channels >= 0, numpy.array(SBS96)[channels], "-")
+				samples = mx["sample"] if "sample" in mx.columns else numpy.full(len(mx), os.path.basename(out))
+				signature.update(samples, channels)
+			if repeats is not None:
+				annotate_repeats(mx, repeats)
+			writer.write(mx)
+			counts.update(mx)
+	
+	return counts
+
+
+def run_jobs(jobs, sequences, ref, ref_seq, coords, chunksize, threads=1, signature=False, compress=False, repeats=None):
+	""" obtain the mutation profile of several mutation lists against one loaded fasta, reading the 
+	alignment positions needed by the position lists (OPTION1) only once
+	input: list of jobs (mutation, output, profiles, before and after), fasta, reference name and 
+	sequence, coordinates, rows per batch, number of processes, whether SBS-96 counts are needed, 
+	whether the tables should be gzipped and RepeatIndex (or None)
+	output: tsv files and reports per job """
+	
+	position_lists = [read_positions(job["mutation"]) for job in jobs]
+	
+	block = None
+	needed = [window_columns(coords, df[df.columns[0]].values, job["before"], job["after"]) for job, df in zip(jobs, position_lists) if df is not None]
+	if len(needed) > 1 and len(sequences) > 1 and len(set(sequences.lengths.tolist())) == 1:
+		cols = numpy.unique(numpy.concatenate(needed))
+		print("Reading the " + str(len(cols)) + " alignment positions needed by the position lists (" + str(sum(len(c) for c in needed)) + " if read per list)...")
+		block = ColumnBlock(sequences, cols)
+	
+	for job, positions_df in zip(jobs, position_lists):
+		if len(jobs) > 1:
+			print("Job " + job["output"] + " (" + job["mutation"] + ")...")
+		print("Reading the mutation list...")
+		if positions_df is None: # OPTIONS 2 and 3 are read in chunks
+			mutations = read_mutations(job["mutation"], chunksize)
+			job_sequences = sequences
+		else:
+			mutations = alignment_batches(positions_df, len(sequences), chunksize)
+			job_sequences = sequences if block is None else block
+		
+		print("Get mutation profile...")
+		counts_sbs96 = SignatureCounts() if signature else None
+		pool = profile_pool(shared_data(job_sequences, job["before"], job["after"], ref, ref_seq, coords, job["profiles"]), threads)
+		try:
+			counts = write_profiles(mutations, job_sequences, job["before"], job["after"], ref, ref_seq, coords, job["profiles"], job["output"], threads, pool, counts_sbs96, compress, repeats)
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+		
+		# check percentage of profiles of interest
+		
+		print("Get summary of the detected profiles of interest.")
+		counts.report(job["output"])
+		
+		if counts_sbs96 is not None:
+			print("Writing the SBS-96 count matrix...")
+			counts_sbs96.write(job["output"] + "_SBS96.tsv")
+
+
+def frequencies(counter):
+	""" report the relative frequency of each observation
+	input: dictionary with the number of times each observation was found
+	output: string """
+	
+	total = sum(counter.values())
+	if total == 0:
+		return " - "
+	
+	info2report = []
+	for v in sorted(counter, key=counter.get, reverse=True):
+		rel_freq = float(counter[v]/total)
+		statistics = str(v) + " (" + str(round(rel_freq * 100,1)) + "%)" 
+		info2report.append(statistics)
+	
+	return ", ".join(info2report) + " (n = " + str(total) + ")"
+
+
+class ProfileSummary:
+	""" running counts of the observed patterns per sample and per reference position, 
+	updated with one grouped count per dataframe """
+	
+	KEYS = ["alt", "motif_sample", "observed_profile", "profile_of_interest"]
+	
+	def __init__(self):
+		self.per_sample = None # sample -> {profile of interest: count}, None without sample information
+		self.total = {} # profile of interest -> count
+		self.per_position = {} # position -> {"ref": str, "motif_ref": str, parameter: {value: count}}
+	
+	@staticmethod
+	def add(counter, key, n):
+		counter[key] = counter.get(key, 0) + int(n)
+	
+	def update(self, mx):
+		""" add the observations of a dataframe of mutation profiles
+		input: pandas matrix """
+		
+		for obs, n in mx["profile_of_interest"].value_counts(sort=False, dropna=False).items():
+			self.add(self.total, obs, n)
+		
+		if "sample" not in mx.columns:
+			return
+		if self.per_sample is None:
+			self.per_sample = {}
+		
+		counts = mx.groupby(["sample", "profile_of_interest"], sort=False, dropna=False).size()
+		for (sample, obs), n in counts.items():
+			self.add(self.per_sample.setdefault(sample, {}), obs, n)
+		
+		first = mx.drop_duplicates("ref_position")
+		for mut, ref, motif in zip(first["ref_position"], first["ref"], first["motif_ref"]):
+			if str(mut) not in self.per_position:
+				self.per_position[str(mut)] = {"ref": ref, "motif_ref": motif}
+		
+		for parameter in self.KEYS:
+			if parameter in mx.columns:
+				counts = mx.groupby(["ref_position", parameter], sort=False, dropna=False).size()
+				for (mut, obs), n in counts.items():
+					self.add(self.per_position[str(mut)].setdefault(parameter, {}), obs, n)
+	
+	def report(self, out):
+		""" print the patterns of interest found and write the report per position
+		input: output tag
+		output: txt file """
+		
+		if self.per_sample is None:
+			print("\tPatterns of interest found: " + frequencies(self.total))
+			return
+		
+		for sample in self.per_sample:
+			print("\tPatterns of interest found in " + str(sample) + ": " + frequencies(self.per_sample[sample]))
+		
+		data2report_df = self.report_table()
+		data2report_df.to_csv(out + "_report.tsv", index = False, header=True, sep ="\t")
+	
+	def report_table(self):
+		""" get the report with the patterns observed per position
+		output: dataframe """
+		
+		data2report = {"ref_position": [], "ref": [], "alt": [], "motif_ref": [], "motif_sample": [], "observed_profile": [], "profile_of_interest": []}
+		for mut, info in self.per_position.items():
+			data2report["ref_position"].append(mut)
+			data2report["ref"].append(info["ref"])
+			data2report["motif_ref"].append(info["motif_ref"])
+			for parameter in self.KEYS:
+				if parameter in info:
+					data2report[parameter].append(frequencies(info[parameter]))
+				else:
+					data2report[parameter].append("-")
+		
+		return pandas.DataFrame(data2report)
+
+
 def summary(mx, out):
 	""" summarize the profiles of interest detected
 	input: pandas matrix
 	output: txt file """
 	
-	if "sample" in mx.columns:
-		for sample in set(mx[mx.columns[0]].values.tolist()):
-			data = mx[mx[mx.columns[0]].astype(str) == sample] # filter the dataframe
-			observations = data["profile_of_interest"].values.tolist()
-			counter = {}
-			for obs in set(observations):
-				counter[obs] = observations.count(obs)
-				info2report = []
-				if len(counter.keys()) > 0:
-					for v in sorted(counter, key=counter.get, reverse=True):
-						rel_freq = float(counter[v]/len(observations))
-						statistics = str(v) + " (" + str(round(rel_freq * 100,1)) + "%)" 
-						info2report.append(statistics)
-					joint = ", ".join(info2report) + " (n = " + str(len(observations)) + ")"
-				else:
-					joint = " - "
-			print("\tPatterns of interest found in " + str(sample) + ": " + joint)
-			
-		data2report = {"ref_position": [], "ref": [], "alt": [], "motif_ref": [], "motif_sample": [], "observed_profile": [], "profile_of_interest": []}
-		keys = ["alt", "motif_sample", "observed_profile", "profile_of_interest"]
-		checked = []
-		for mut in mx["ref_position"].values.tolist():
-			if mut not in checked:
-				data = mx[mx["ref_position"].astype(str) == str(mut)]
-				data2report["ref_position"].append(str(mut))
-				data2report["ref"].append(data["ref"].values.tolist()[0])
-				data2report["motif_ref"].append(data["motif_ref"].values.tolist()[0])
-				
-				for parameter in keys:
-					if parameter in data.columns:
-						observations = data[parameter].values.tolist()
-						counter = {}
-						for obs in set(observations):
-							counter[obs] = observations.count(obs)
-							info2report = []
-							if len(counter.keys()) > 0:
-								for v in sorted(counter, key=counter.get, reverse=True):
-									rel_freq = float(counter[v]/len(observations))
-									statistics = str(v) + " (" + str(round(rel_freq * 100,1)) + "%)" 
-									info2report.append(statistics)
-								joint = ", ".join(info2report) + " (n = " + str(len(observations)) + ")"
-							else:
-								joint = " - "
-						data2report[parameter].append(joint)
-				
-					else:
-						data2report[parameter].append("-")
-				checked.append(mut)	
-		
-		data2report_df = pandas.DataFrame(data2report)
-		data2report_df.to_csv(out + "_report.tsv", index = False, header=True, sep ="\t")
-					
-	else:
-		data = mx # filter the dataframe
-		observations = data["profile_of_interest"].values.tolist()
-		counter = {}
-		for obs in set(observations):
-			counter[obs] = observations.count(obs)
-			info2report = []
-			if len(counter.keys()) > 0:
-				for v in sorted(counter, key=counter.get, reverse=True):
-					rel_freq = float(counter[v]/len(observations))
-					statistics = str(v) + " (" + str(round(rel_freq * 100,1)) + "%)" 
-					info2report.append(statistics)
-				joint = ", ".join(info2report) + " (n = " + str(len(observations)) + ")"
+	counts = ProfileSummary()
+	counts.update(mx)
+	counts.report(out)
+		
+		
+class ProfileServer:
+	""" answer mutation profile queries over HTTP (TCP or Unix socket) with the fasta, reference and 
+	coordinates kept in memory and an LRU cache of the answers
+	
+	GET /profile?positions=1,2&alt=A,T&before=5&after=5&profiles=GA>AA,TC>TT&format=tsv
+		profile of the positions in every sample of the alignment (OPTION1), or of the alternative 
+		alleles if 'alt' is given (OPTION2); all parameters except 'positions' are optional
+	GET /report?...
+		same parameters, patterns observed per position (or overall with 'alt')
+	GET /
+		server information """
+	
+	def __init__(self, sequences, ref, ref_seq, coords, before, after, profiles, cache_size, repeats=None):
+		self.sequences = sequences
+		self.ref = ref
+		self.ref_seq = ref_seq
+		self.ref_length = len(ref_seq.replace("-", ""))
+		self.coords = coords
+		self.repeats = repeats
+		self.defaults = {"before": before, "after": after, "profiles": profiles}
+		self.cached_query = functools.lru_cache(maxsize=cache_size)(self.query)
+	
+	def query(self, endpoint, positions, alts, before, after, profiles, fmt):
+		""" compute the answer to a query
+		input: endpoint (profile or report), tuple of positions, tuple of alternative alleles (can be 
+		empty), motif limits, profiles of interest and output format (tsv or json)
+		output: answer (str) """
+		
+		if len(alts) > 0:
+			ref_nogaps = self.ref_seq.replace("-", "")
+			mutation_df = pandas.DataFrame({"POS": positions, "REF": [ref_nogaps[p - 1] for p in positions], "ALT": alts})
+		else:
+			mutation_df = pandas.DataFrame({"position": positions})
+		mx = mut_profile(self.sequences, before, after, self.ref, self.ref_seq, self.coords, profiles, mutation_df)
+		if self.repeats is not None:
+			annotate_repeats(mx, self.repeats)
+		
+		if endpoint == "report":
+			counts = ProfileSummary()
+			counts.update(mx)
+			if counts.per_sample is None:
+				mx = pandas.DataFrame({"patterns_of_interest": [frequencies(counts.total)]})
 			else:
-				joint = " - "
-		print("\tPatterns of interest found: " + joint)
+				mx = counts.report_table()
 		
+		if fmt == "json":
+			return mx.to_json(orient="records")
+		return mx.to_csv(index = False, header=True, sep ="\t")
+	
+	def parse(self, target):
+		""" get the arguments of a query from the request target
+		input: request target (path and query string)
+		output: arguments of query() """
+		
+		url = urllib.parse.urlsplit(target)
+		endpoint = url.path.strip("/")
+		if endpoint not in ["profile", "report"]:
+			raise LookupError(url.path)
+		params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+		
+		positions = tuple(int(p) for p in params.get("positions", params.get("pos", "")).split(",") if p != "")
+		alts = tuple(a.upper() for a in params.get("alt", "").split(",") if a != "")
+		before = int(params.get("before", self.defaults["before"]))
+		after = int(params.get("after", self.defaults["after"]))
+		profiles = params.get("profiles", self.defaults["profiles"])
+		fmt = params.get("format", "tsv")
 		
+		if len(positions) == 0:
+			raise ValueError("no positions were provided")
+		if len(alts) > 0 and len(alts) != len(positions):
+			raise ValueError("the number of alternative alleles is different from the number of positions")
+		if len(alts) == 0 and len(self.sequences) == 1:
+			raise ValueError("only 1 sequence was loaded, the alternative alleles (alt) are required")
+		if len(alts) == 0 and len(set(self.sequences.lengths.tolist())) > 1:
+			raise ValueError("the sequences in the fasta file do not have the same length, the alternative alleles (alt) are required")
+		if before < 0 or after < 0:
+			raise ValueError("before and after cannot be negative")
+		if min(positions) - max(before, 1) < 1 or max(positions) + max(after, 1) > self.ref_length:
+			raise ValueError("the motif window is outside the reference sequence")
+		if fmt not in ["tsv", "json"]:
+			raise ValueError("format must be tsv or json")
+		
+		return endpoint, positions, alts, before, after, profiles, fmt
+	
+	async def handle(self, reader, writer):
+		""" answer one HTTP request """
+		
+		status, content_type = "200 OK", "text/plain"
+		try:
+			request = (await reader.readline()).decode("latin-1").split()
+			while (await reader.readline()).strip(): # headers
+				pass
+			if len(request) < 2 or request[0] != "GET":
+				status, body = "405 Method Not Allowed", "Only GET requests are accepted\n"
+			elif urllib.parse.urlsplit(request[1]).path.strip("/") == "":
+				info = self.cached_query.cache_info()
+				body = "get_mutation_profile.py server\nreference: " + self.ref + "\nsequences: " + str(len(self.sequences)) + "\ncached answers: " + str(info.currsize) + " (hits = " + str(info.hits) + ", misses = " + str(info.misses) + ")\n"
+			else:
+				query = self.parse(request[1])
+				body = await asyncio.get_running_loop().run_in_executor(None, self.cached_query, *query)
+				content_type = "application/json" if query[-1] == "json" else "text/tab-separated-values"
+		except LookupError as err:
+			status, body = "404 Not Found", "Unknown endpoint " + str(err) + "\n"
+		except ValueError as err:
+			status, body = "400 Bad Request", str(err) + "\n"
+		except SystemExit: # checks of the command line mode (the message was printed)
+			status, body = "400 Bad Request", "The query cannot be answered with the loaded fasta\n"
+		except Exception as err:
+			status, body = "500 Internal Server Error", repr(err) + "\n"
+		
+		data = body.encode()
+		writer.write(("HTTP/1.0 " + status + "\r\nContent-Type: " + content_type + "\r\nContent-Length: " + str(len(data)) + "\r\nConnection: close\r\n\r\n").encode() + data)
+		try:
+			await writer.drain()
+		finally:
+			writer.close()
+	
+	async def serve(self, socket_path=None, host="127.0.0.1", port=8765):
+		""" listen on a Unix socket (if provided) or on a TCP port until interrupted """
+		
+		if socket_path is not None:
+			if os.path.exists(socket_path):
+				os.remove(socket_path)
+			server = await asyncio.start_unix_server(self.handle, path=socket_path)
+			print("Listening on the Unix socket " + socket_path + " (e.g. curl --unix-socket " + socket_path + " 'http://localhost/profile?positions=100')")
+		else:
+			server = await asyncio.start_server(self.handle, host=host, port=port)
+			print("Listening on http://" + host + ":" + str(port) + " (e.g. curl 'http://" + host + ":" + str(port) + "/profile?positions=100')")
+		
+		async with server:
+			await server.serve_forever()
+
+
 # main	----------
 
 if __name__ == "__main__":
@@ -277,62 +1297,106 @@ if __name__ == "__main__":
 									
 									NOTE: IN OPTIONS 2 AND 3, THE ORDER OF THE COLUMNS IN THE INPUT 1 IS NOT
 									IMPORTANT, BUT THEIR NAME IS (ID, POS, REF, ALT)!!!
+									IN OPTIONS 2 AND 3, INPUT 1 CAN ALSO BE A VCF FILE AND IT IS PROCESSED IN 
+									CHUNKS OF ROWS (-c).
 									-----------------------------------------------------------------------------"""))
 	
 	group0 = parser.add_argument_group("Mutation profile", "Provide input/output specifications")
-	group0.add_argument("-f", "--fasta", dest="fasta", required=True, type=str, help="[MANDATORY] Input sequence file (fasta)")
-	group0.add_argument("-m", "--mutation_list", dest="mutation", required=True, type=str, help="[MANDATORY] Input mutation list that can be: 1) single-column file with 1-based reference position\
+	group0.add_argument("-f", "--fasta", dest="fasta", required=True, type=str, help="[MANDATORY] Input sequence file (fasta, can be gzipped). A samtools .fai index is used if available")
+	group0.add_argument("-m", "--mutation_list", dest="mutation", required=False, type=str, help="[MANDATORY, unless --batch or --serve is used] Input mutation list that can be: 1) single-column file with 1-based reference position\
 						information (in this case the fasta file must be a multiple sequence alignment of all the sequences of interest); OR 2) tsv file with the columns POS, REF, and ALT \
 						where POS = 1-based reference position. If you want to include information for more than one sample per position, add also the column 'ID' (note that the order of the \
-						columns is not important but their name is!)")
+						columns is not important but their name is!); OR 3) VCF file (can be gzipped/bgzipped), with one row per alternative allele or, if it has genotypes, \
+						per sample and alternative allele in its genotype")
 	group0.add_argument("-r", "--reference", dest="ref", type=str, required=True, help="[MANDATORY] Reference sequence name")
 	group0.add_argument("-b", "--before", dest="before", type=int, default=5, help="[OPTIONAL] Number of nucleotides to report BEFORE the mutation (default = 5)")
 	group0.add_argument("-a", "--after", dest="after", type=int, default=5, help="[OPTIONAL] Number of nucleotides to report AFTER the mutation (default = 5)")
 	group0.add_argument("-p", "--profiles", dest="profiles", type=str, default="GA>AA,TC>TT", help="[OPTIONAL] Comma-separated list of mutational profiles of interest (upper-case!). \
 						Default = 'GA>AA,TC>TT'")
 	group0.add_argument("-o", "--output", dest="output", type=str, default="Mutation_profile", help="[OPTIONAL] Tag for output file name. Default = Mutation_profile")
+	group0.add_argument("-s", "--signature", dest="signature", type=str, choices=["sbs96"], default=None, help="[OPTIONAL] Also classify the single base \
+						substitutions in the 96 trinucleotide-context channels (SBS-96): adds the column 'sbs96' and writes the count matrix per sample to \
+						<output>_SBS96.tsv")
+	group0.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=1000000, help="[OPTIONAL] Number of rows of the mutation list (OPTIONS 2 and 3) \
+						or of the output (OPTION1) processed and written at once. Default = 1000000")
+	group0.add_argument("-z", "--gzip", dest="gzip", action="store_true", help="[OPTIONAL] Write the mutation profile table gzipped (<output>.tsv.gz)")
+	group0.add_argument("--repeats", dest="repeats", type=str, default=None, help="[OPTIONAL] BED file with repeat regions in reference coordinates (e.g. Final.bed \
+						of polybed.py). The columns in_repeat and repeat_class are added to the mutation profile")
+	group0.add_argument("--cache", dest="cache", type=str, default=None, help="[OPTIONAL] Directory where the alignment matrix and coordinates are cached to \
+						speed up later runs with the same fasta and reference. The cache is rebuilt when the fasta content changes")
+	group0.add_argument("--cache-size", dest="cache_size", type=float, default=50, help="[OPTIONAL] Maximum size (GB) of the cache directory. The least \
+						recently used caches are removed first. Default = 50")
+	group0.add_argument("-t", "--threads", dest="threads", type=int, default=1, help="[OPTIONAL] Number of processes used to profile the sequences (OPTION1) or the \
+						rows of the mutation list (OPTIONS 2 and 3) in parallel. Default = 1")
 
+	group1 = parser.add_argument_group("Batch mode", "Profile several mutation lists against the same fasta file")
+	group1.add_argument("--batch", dest="batch", type=str, default=None, help="[OPTIONAL] TSV file with one job per row and the columns 'mutation_list' and \
+						'output' (output tag), and optionally 'profiles', 'before' and 'after' (if absent or empty, -p, -b and -a are used). The fasta file is \
+						loaded once and the alignment positions needed by several position lists are read only once. -m and -o are ignored")
+	
+	group2 = parser.add_argument_group("Server mode", "Keep the fasta file in memory and answer queries over HTTP")
+	group2.add_argument("--serve", dest="serve", action="store_true", help="[OPTIONAL] Start a server answering GET /profile and GET /report requests with \
+						the parameters positions (comma-separated), alt, before, after, profiles and format (tsv or json). -m, -o and --batch are ignored")
+	group2.add_argument("--socket", dest="socket", type=str, default=None, help="[OPTIONAL] Unix socket used by the server (if not provided, --host and --port are used)")
+	group2.add_argument("--host", dest="host", type=str, default="127.0.0.1", help="[OPTIONAL] Host address of the server. Default = 127.0.0.1")
+	group2.add_argument("--port", dest="port", type=int, default=8765, help="[OPTIONAL] Port of the server. Default = 8765")
+	group2.add_argument("--query-cache", dest="query_cache", type=int, default=1024, help="[OPTIONAL] Number of answers kept in the LRU cache of the server. Default = 1024")
+	
 	args = parser.parse_args()
 	
+	if args.mutation is None and args.batch is None and not args.serve:
+		parser.error("a mutation list (-m), a batch file (--batch) or the server mode (--serve) is required")
+	
 	# read fasta file
 	
 	print("Loading the fasta sequence...")
-	sequences = AlignIO.read(args.fasta, "fasta")
+	if args.cache is not None:
+		sequences = open_cache(args.fasta, args.ref, args.cache, args.cache_size * 2**30)
+	else:
+		sequences = load_fasta(args.fasta)
 	print("\tLoaded " + str(len(sequences)) + " sequences.")
 	
 	# get reference sequence
 	
 	print("Defining reference sequence...")
 	reference = args.ref
-	ref_seq = ""
-	for record in sequences:
-		if record.id == reference:
-			ref_seq = record.seq.upper()
+	ref_seq = sequences.sequence(reference)
 	
-	if ref_seq == "":
+	if ref_seq is None:
 		print("Could not find the reference name in the fasta provided!!! Cannot continue!")
 		sys.exit()
 	
-	# read the mutation list
-	
-	print("Reading the mutation list...")
-	mutation_df = pandas.read_table(args.mutation)
-	
 	# get coordinate correspondence
 	
 	print("Get reference and alignment position correspondence...")
-	coords = get_ref_coords(ref_seq)
-			
+	if isinstance(sequences, AlignmentCache):
+		coords = sequences.coords
+	else:
+		coords = get_ref_coords(ref_seq)
+	
+	# get repeat regions
+	
+	repeats = None
+	if args.repeats is not None:
+		print("Loading the repeat regions...")
+		repeats = RepeatIndex(args.repeats)
+		print("\tLoaded " + str(repeats.intervals) + " intervals.")
+	
 	# get profile information
 	
-	print("Get mutation profile...")
-	mx = mut_profile(sequences, int(args.before), int(args.after), reference, ref_seq, coords, args.profiles, mutation_df)
-	mx.to_csv(args.output + ".tsv", index = False, header=True, sep ="\t")
-
-	# check percentage of profiles of interest
+	if args.serve:
+		server = ProfileServer(sequences, reference, ref_seq, coords, int(args.before), int(args.after), args.profiles, args.query_cache, repeats)
+		try:
+			asyncio.run(server.serve(args.socket, args.host, args.port))
+		except KeyboardInterrupt:
+			print("Server stopped.")
+		sys.exit()
 	
-	print("Get summary of the detected profiles of interest.")
-	summary(mx, args.output)
+	if args.batch is not None:
+		jobs = read_manifest(args.batch, int(args.before), int(args.after), args.profiles)
+	else:
+		jobs = [{"mutation": args.mutation, "output": args.output, "profiles": args.profiles, "before": int(args.before), "after": int(args.after)}]
+	run_jobs(jobs, sequences, reference, ref_seq, coords, args.chunk_size, args.threads, args.signature == "sbs96", args.gzip, repeats)
 	
 	"""
 	# generate snipit plot
@@ -10,42 +10,166 @@ NOTE: DATE FORMAT REQUIRED DD/MM/YYYY
 Launch the script:
 python3 get_summary_table.py input.tsv output.tsv
 
-By Veronica Mixao 
+Keep the per-lineage state to update the summary later only with the new rows:
+python3 get_summary_table.py input.tsv output.tsv --state summary_state.pkl
+python3 get_summary_table.py output.tsv --state summary_state.pkl --update new_rows.tsv
+
+By Veronica Mixao
 @INSA
 vmixao@gmail.com
 """
 
+import os
+import sys
+import pickle
+import argparse
 import pandas
 import numpy
-import sys
 
-filename  = sys.argv[1]
 
-data = pandas.read_table(filename)
-data_out = {"lineage": [], "first_seq_date": [], "last_seq_date": [], "n_District": [], "n_Municipality": [], "n_sequences": []}
+# functions	----------
+
+def read_data(filename):
+	""" read the table of isolates parsing the dates once
+	input: tab delimited table
+	output: pandas dataframe """
+	
+	data = pandas.read_table(filename, dtype={"lineage": "category", "division": "category", "location": "category"})
+	
+	try:
+		data["date"] = pandas.to_datetime(data["date"], format="%d/%m/%Y") #converting date format (once)
+	except ValueError:
+		data["date"] = pandas.to_datetime(data["date"], dayfirst=True)
+	
+	return data
+
+
+def summary_table(data):
+	""" summarize the isolates of each lineage in one grouped pass
+	input: pandas dataframe
+	output: summary dataframe and list of lineages with repeated sequences """
+	
+	groups = data.groupby("lineage", observed=True, sort=True)
+	new_data = groups["date"].agg(first_seq_date="min", last_seq_date="max")
+	for column, col in [("n_District", "division"), ("n_Municipality", "location"), ("n_sequences", "strain")]: #number of different values (NaN included)
+		new_data[column] = data[["lineage", col]].drop_duplicates().groupby("lineage", observed=True, sort=True).size()
+	new_data = new_data.reset_index()
+	new_data["first_seq_date"] = new_data["first_seq_date"].dt.date
+	new_data["last_seq_date"] = new_data["last_seq_date"].dt.date
+	new_data["lineage"] = new_data["lineage"].astype(str)
+	
+	#compare number of unique sequences with the number of lines
+	repeated = new_data["lineage"][new_data["n_sequences"].values != groups.size().values].tolist()
+	
+	return new_data, repeated
+
+
+def build_state(data):
+	""" get the aggregate state of each lineage
+	input: pandas dataframe
+	output: dictionary lineage -> {"first": date, "last": date, "strains": set, "locations": set,
+	"divisions": set, "rows": int} (NaN values are kept as None) """
+	
+	state = {}
+	data = data[data["lineage"].notna()]
+	groups = data.groupby("lineage", observed=True, sort=False)
+	dates = groups["date"].agg(["min", "max"])
+	rows = groups.size()
+	for lin in rows.index:
+		first, last = dates.loc[lin, "min"], dates.loc[lin, "max"]
+		state[str(lin)] = {"first": None if pandas.isna(first) else first.date(), "last": None if pandas.isna(last) else last.date(), \
+							"strains": set(), "locations": set(), "divisions": set(), "rows": int(rows[lin])}
+	
+	for key, col in [("strains", "strain"), ("locations", "location"), ("divisions", "division")]:
+		values = data[["lineage", col]].drop_duplicates()
+		for lin, value in zip(values["lineage"].astype(str), values[col].astype(object)):
+			state[lin][key].add(None if pandas.isna(value) else value)
+	
+	return state
 
-lineages = data["lineage"].values.tolist()
 
-for lin in set(lineages):
-	flt_data = data[data.lineage == lin] #filter the dataframe
-	if len(flt_data.strain.unique()) != len(flt_data.lineage): #compare number of unique sequences with the number of lines
-		#print(flt_data.strain.unique(), flt_data.lineage)
+def update_state(state, new_state):
+	""" merge the aggregate state of new rows into the current state
+	input: current and new states
+	output: updated state """
+	
+	for lin, info in new_state.items():
+		if lin not in state:
+			state[lin] = info
+			continue
+		current = state[lin]
+		for key, function in [("first", min), ("last", max)]:
+			dates = [d for d in [current[key], info[key]] if d is not None]
+			current[key] = function(dates) if len(dates) > 0 else None
+		for key in ["strains", "locations", "divisions"]:
+			current[key] |= info[key]
+		current["rows"] += info["rows"]
+	
+	return state
+
+
+def state_table(state):
+	""" summarize the isolates of each lineage from the aggregate state
+	input: state
+	output: summary dataframe and list of lineages with repeated sequences """
+	
+	lineages = sorted(state)
+	new_data = pandas.DataFrame({"lineage": lineages, \
+								"first_seq_date": [state[lin]["first"] for lin in lineages], \
+								"last_seq_date": [state[lin]["last"] for lin in lineages], \
+								"n_District": [len(state[lin]["divisions"]) for lin in lineages], \
+								"n_Municipality": [len(state[lin]["locations"]) for lin in lineages], \
+								"n_sequences": [len(state[lin]["strains"]) for lin in lineages]})
+	repeated = [lin for lin in lineages if len(state[lin]["strains"]) != state[lin]["rows"]]
+	
+	return new_data, repeated
+
+
+def write_summary(new_data, repeated, output):
+	""" write the summary table sorted by the number of sequences """
+	
+	for lin in repeated:
 		print("Warning!!! You have a repetitive sequence in lineage ", lin)
-			
-	n_seq = len(flt_data.strain.unique()) #number of different sequences
-	n_mun = len(flt_data.location.unique()) #number of different locations
-	n_dis = len(flt_data.division.unique()) #number of different divisions
-	date = pandas.to_datetime(flt_data.date, dayfirst=True).dt.date #converting date format
-		
-	data_out["lineage"].append(lin)
-	data_out["first_seq_date"].append(min(date))
-	data_out["last_seq_date"].append(max(date))
-	data_out["n_District"].append(n_dis)
-	data_out["n_Municipality"].append(n_mun)
-	data_out["n_sequences"].append(n_seq)
-
-new_data = pandas.DataFrame(data = data_out)
-
-out = new_data.sort_values(by=["n_sequences"], ascending=False) #modify according to the sorting parameter
-
-out.to_csv(sys.argv[2], index = False, header=True, sep ="\t")
+	
+	out = new_data.sort_values(by=["n_sequences"], ascending=False, kind="stable") #modify according to the sorting parameter
+	
+	out.to_csv(output, index = False, header=True, sep ="\t")
+
+
+# main	----------
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Generate the summary table of all isolates per lineage")
+	parser.add_argument("input", nargs="?", default=None, help="Tab delimited table with the columns strain, date (DD/MM/YYYY), division, location and lineage \
+						(optional with --update if the state file exists)")
+	parser.add_argument("output", help="Output summary table")
+	parser.add_argument("--state", dest="state", default=None, help="[OPTIONAL] File with the aggregate state per lineage (written after each run)")
+	parser.add_argument("--update", dest="update", default=None, help="[OPTIONAL] Table with new rows to merge into the state (requires --state)")
+	
+	args = parser.parse_args()
+	
+	if args.update is not None and args.state is None:
+		parser.error("--update requires --state")
+	if args.input is None and (args.update is None or not os.path.exists(args.state)):
+		parser.error("the input table is required (unless --update is used with an existing state file)")
+	
+	if args.state is None:
+		new_data, repeated = summary_table(read_data(args.input))
+		write_summary(new_data, repeated, args.output)
+		sys.exit()
+	
+	if args.update is not None and os.path.exists(args.state):
+		with open(args.state, "rb") as infile:
+			state = pickle.load(infile)
+	else:
+		state = build_state(read_data(args.input))
+	
+	if args.update is not None:
+		state = update_state(state, build_state(read_data(args.update)))
+	
+	with open(args.state, "wb") as out:
+		pickle.dump(state, out)
+	
+	new_data, repeated = state_table(state)
+	write_summary(new_data, repeated, args.output)
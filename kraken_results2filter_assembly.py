@@ -7,49 +7,319 @@ By Veronica Mixao
 @INSA
 """
 
+import os
+import re
+import csv
+import sys
+import time
+import gzip
+import mmap
+import multiprocessing
 import argparse
 import textwrap
-from Bio import SeqIO
+import numpy
+
+TAXID = re.compile(r"\(taxid (\d+)\)")
+SHARED = {} # taxa of interest shared by the processes of the batch mode
 
 # functions	----------
 
 def get_ids(taxonid_file):
 	""" Get the taxon ids
 	input: list
-	output: list """
+	output: set """
 	
-	ids = []
+	ids = set()
 	with open(taxonid_file) as tfile:
-		for line in tfile.readlines():
-			ids.append(line.split("\n")[0])
+		for line in tfile:
+			taxon_id = line.strip()
+			if taxon_id != "":
+				ids.add(taxon_id)
 	return ids
 
-def get_contigs(ids, kraken_output):
+class Taxonomy:
+	""" NCBI taxonomy (nodes.dmp) as a parent array with the preorder interval [tin, tout] of 
+	each taxon, so that the descendants of a taxon are the nodes order[tin:tout + 1] """
+	
+	def __init__(self, nodes):
+		index = nodes + ".index.npz"
+		stat = os.stat(nodes)
+		source = numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+		
+		if os.path.exists(index):
+			with numpy.load(index) as data:
+				if numpy.array_equal(data["source"], source):
+					self.parent, self.tin, self.tout, self.order = data["parent"], data["tin"], data["tout"], data["order"]
+					return
+		
+		print("Indexing the taxonomy in " + nodes + "...")
+		self.parent = self.read_nodes(nodes)
+		self.tin, self.tout, self.order = self.euler_tour(self.parent)
+		try:
+			numpy.savez(index, source=source, parent=self.parent, tin=self.tin, tout=self.tout, order=self.order)
+		except OSError:
+			print("\tCould not save the taxonomy index in " + index + ".")
+	
+	@staticmethod
+	def read_nodes(nodes):
+		""" read the parent of each taxon
+		input: nodes.dmp
+		output: array with the parent of each taxid (-1 if the taxid does not exist) """
+		
+		taxids = []
+		parents = []
+		with open(nodes) as infile:
+			for line in infile:
+				l = line.split("\t|\t", 2)
+				taxids.append(int(l[0]))
+				parents.append(int(l[1]))
+		
+		parent = numpy.full(max(taxids) + 1, -1, dtype=numpy.int32)
+		parent[taxids] = parents
+		return parent
+	
+	@staticmethod
+	def euler_tour(parent):
+		""" number the taxa in preorder with an iterative depth-first search
+		input: parent array
+		output: arrays tin and tout (first and last preorder number of the subtree of each 
+		taxid) and order (taxid with each preorder number) """
+		
+		n = len(parent)
+		exists = parent >= 0
+		is_root = exists & ((parent == numpy.arange(n)) | ~exists[numpy.maximum(parent, 0)])
+		
+		# children of each taxon in CSR format
+		child = numpy.flatnonzero(exists & ~is_root)
+		child = child[numpy.argsort(parent[child], kind="stable")]
+		first = numpy.searchsorted(parent[child], numpy.arange(n + 1))
+		
+		tin = numpy.full(n, -1, dtype=numpy.int32)
+		tout = numpy.full(n, -1, dtype=numpy.int32)
+		order = numpy.zeros(exists.sum(), dtype=numpy.int32)
+		counter = 0
+		for root in numpy.flatnonzero(is_root):
+			stack = [int(root)]
+			while stack:
+				node = stack.pop()
+				tin[node] = counter
+				order[counter] = node
+				counter += 1
+				stack.extend(child[first[node]:first[node + 1]].tolist())
+		
+		# last preorder number of each subtree from the subtree sizes (children before parents)
+		size = numpy.ones(n, dtype=numpy.int32)
+		for node in order[::-1]:
+			if not is_root[node]:
+				size[parent[node]] += size[node]
+		tout[exists] = tin[exists] + size[exists] - 1
+		
+		return tin, tout, order
+	
+	def targets(self, ids):
+		""" assign each taxon to the closest of the taxa of interest it descends from
+		input: set of taxon ids
+		output: array with the assigned taxid of each taxid (0 if not assigned) """
+		
+		assigned = numpy.zeros(len(self.parent), dtype=numpy.int64)
+		valid = [int(t) for t in ids if t.isdigit() and int(t) < len(self.parent) and self.tin[int(t)] >= 0]
+		missing = [t for t in ids if not t.isdigit() or int(t) not in valid]
+		if len(missing) > 0:
+			print("\tTaxon IDs not found in the taxonomy (only exact matches): " + ", ".join(sorted(missing)))
+		
+		for t in sorted(valid, key=lambda t: self.tout[t] - self.tin[t], reverse=True): # nested taxa override
+			assigned[self.order[self.tin[t]:self.tout[t] + 1]] = t
+		return assigned
+
+
+def get_taxid(field):
+	""" Get the taxon id of the kraken output (also with --use-names, 'name (taxid N)') """
+	
+	match = TAXID.search(field)
+	return match.group(1) if match else field.strip()
+
+def get_contigs(ids, kraken_output, assigned=None):
 	""" Get contigs of iterest
-	input: dictionary and kraken output
-	outpu: list """
+	input: set, kraken output and array with the taxon of interest of each taxid (descendants)
+	outpu: dictionary with the taxon id of each contig """
 	
-	contigs = []
+	contigs = {}
 	with open(kraken_output) as kfile:
-		for line in kfile.readlines():
+		for line in kfile:
 			l = line.split("\t")
+			if len(l) < 3:
+				continue
 			contig_name = l[1]
-			taxon_id = l[2]
+			taxon_id = get_taxid(l[2])
 			
-			if taxon_id in ids:
-				contigs.append(contig_name)
+			if assigned is not None and taxon_id.isdigit() and int(taxon_id) < len(assigned) and assigned[int(taxon_id)] > 0:
+				contigs[contig_name] = str(assigned[int(taxon_id)])
+			elif taxon_id in ids: # exact match (also taxa missing from the taxonomy, e.g. 0)
+				contigs[contig_name] = taxon_id
 	return contigs
 
-def flt_fasta(contigs, assembly, out):
-	""" Filter the fasta file
-	input: dictionary and fasta
-	output: fasta """
+def record_name(header):
+	""" Get the contig name (first word) of a fasta header
+	input: header line (bytes)
+	output: str """
+	
+	words = header[1:].split(None, 1)
+	return words[0].decode() if len(words) > 0 else ""
+
+def scan_records(data):
+	""" Get the byte span of each fasta record
+	input: mmap of the fasta
+	output: iterator of (start, end, contig name) """
+	
+	start = data.find(b">") if data[:1] != b">" else 0
+	while start != -1:
+		end = data.find(b"\n>", start)
+		end = len(data) if end == -1 else end + 1
+		header_end = data.find(b"\n", start, end)
+		yield start, end, record_name(data[start:end if header_end == -1 else header_end])
+		start = end if end < len(data) else -1
+
+def fai_records(data, fai, contigs):
+	""" Get the byte span of the fasta records of interest from the samtools index
+	input: mmap of the fasta, .fai file and dictionary with the contigs of interest
+	output: iterator of (start, end, contig name) and number of records """
+	
+	offsets = []
+	with open(fai) as infile:
+		for line in infile:
+			l = line.split("\t")
+			offsets.append((int(l[2]), l[0]))
+	offsets.sort()
+	
+	def records():
+		for i, (offset, name) in enumerate(offsets):
+			if name in contigs:
+				start = data.rfind(b"\n>", 0, offset) + 1
+				end = len(data) if i + 1 == len(offsets) else data.rfind(b"\n>", 0, offsets[i + 1][0]) + 1
+				yield start, end, name
+	
+	return records(), len(offsets)
+
+def flt_fasta(contigs, assembly, out, split=False):
+	""" Filter the fasta file copying the original bytes of the selected records
+	input: dictionary, fasta (plain, with or without .fai, or gzipped), output tag and whether 
+	a fasta should be written per taxon id
+	output: fasta(s), number of kept and total contigs """
+	
+	outputs = {}
+	kept = 0
+	total = 0
+	
+	def get_output(name):
+		taxon_id = contigs.get(name)
+		if taxon_id is None:
+			return None
+		outname = out + "_" + taxon_id + ".fasta" if split else out + ".fasta"
+		if outname not in outputs:
+			outputs[outname] = open(outname, "wb", buffering=2**20)
+		return outputs[outname]
 	
-	with open(out + ".fasta", "w+") as output:
-		for record in SeqIO.parse(assembly, "fasta"):
-			if record.id in contigs:
-				print(">" + str(record.id), file = output)
-				print(str(record.seq), file = output)		
+	try:
+		with open(assembly, "rb") as infile:
+			gzipped = infile.read(2) == b"\x1f\x8b"
+		
+		if gzipped: # stream the decompressed lines
+			with gzip.open(assembly, "rb") as infile:
+				output = None
+				line = b""
+				for line in infile:
+					if line.startswith(b">"):
+						total += 1
+						output = get_output(record_name(line))
+						kept += output is not None
+					if output is not None:
+						output.write(line)
+				if output is not None and not line.endswith(b"\n"):
+					output.write(b"\n")
+		
+		elif os.path.getsize(assembly) > 0:
+			with open(assembly, "rb") as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				fai = assembly + ".fai"
+				if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(assembly):
+					records, total = fai_records(data, fai, contigs)
+				else:
+					records = scan_records(data)
+					total = None
+				
+				# consecutive records going to the same output are copied at once
+				view = memoryview(data)
+				run = None # [output, start, end]
+				scanned = 0
+				for start, end, name in records:
+					scanned += 1
+					output = get_output(name)
+					if output is None:
+						continue
+					kept += 1
+					if run is not None and run[0] is output and run[2] == start:
+						run[2] = end
+						continue
+					if run is not None:
+						run[0].write(view[run[1]:run[2]])
+					run = [output, start, end]
+				if run is not None:
+					run[0].write(view[run[1]:run[2]])
+					if data[run[2] - 1:run[2]] != b"\n":
+						run[0].write(b"\n")
+				view.release()
+				if total is None:
+					total = scanned
+	finally:
+		for output in outputs.values():
+			output.close()
+	
+	if not split and len(outputs) == 0: # keep an (empty) output as before
+		open(out + ".fasta", "w+").close()
+	
+	return kept, total
+
+def read_samples(sample_sheet):
+	""" Get the samples of the batch mode
+	input: TSV with the columns kraken_output, assembly and output_tag
+	output: list of dictionaries """
+	
+	with open(sample_sheet) as infile:
+		samples = [row for row in csv.DictReader(infile, delimiter="\t")]
+	if len(samples) > 0 and any(col not in samples[0] for col in ["kraken_output", "assembly", "output_tag"]):
+		print("The sample sheet must have the columns 'kraken_output', 'assembly' and 'output_tag'! Cannot continue!!!")
+		sys.exit()
+	return samples
+
+def init_worker(ids, assigned, split):
+	""" Share the taxa of interest with the processes of the pool """
+	
+	SHARED["ids"] = ids
+	SHARED["assigned"] = assigned
+	SHARED["split"] = split
+
+def filter_sample(sample):
+	""" Filter the assembly of one sample of the batch mode
+	input: dictionary with kraken_output, assembly and output_tag
+	output: output tag, number of kept and total contigs, seconds and MB of the assembly """
+	
+	start = time.perf_counter()
+	contigs = get_contigs(SHARED["ids"], sample["kraken_output"], SHARED["assigned"])
+	kept, total = flt_fasta(contigs, sample["assembly"], sample["output_tag"], SHARED["split"])
+	seconds = time.perf_counter() - start
+	
+	return sample["output_tag"], kept, total, seconds, os.path.getsize(sample["assembly"]) / 2**20
+
+def run_batch(samples, ids, assigned, split, threads):
+	""" Filter the assemblies of several samples in parallel
+	input: list of samples, set of taxon ids, array with the taxon of interest of each taxid (or None), 
+	whether a fasta should be written per taxon id and number of processes
+	output: fasta(s) per sample """
+	
+	start = time.perf_counter()
+	with multiprocessing.Pool(max(1, min(threads, len(samples))), initializer=init_worker, initargs=(ids, assigned, split)) as pool:
+		for tag, kept, total, seconds, size in pool.imap_unordered(filter_sample, samples):
+			print("\t" + tag + ": kept " + str(kept) + ", dropped " + str(total - kept) + " contigs in " + str(round(seconds, 2)) + " s (" + str(round(size / max(seconds, 1e-6), 1)) + " MB/s)")
+	print("Filtered " + str(len(samples)) + " samples in " + str(round(time.perf_counter() - start, 2)) + " s.")
 	
 	
 # main	----------
@@ -67,16 +337,52 @@ if __name__ == "__main__":
 									                            
 									Filter an assembly according to Kraken results.
 									
+									With --split, the contigs of each Taxon ID are written to a different 
+									fasta file (<output>_<taxon id>.fasta) in a single pass.
+									
+									With --include-descendants, the contigs of every taxon below the Taxon IDs 
+									of interest are also kept (and written to the file of the closest Taxon ID 
+									of interest with --split). The taxonomy index is saved next to nodes.dmp.
+									
+									The selected records are copied as they are in the assembly (plain or 
+									gzipped). If the assembly has an up-to-date samtools index (.fai), it is 
+									used to locate the records instead of scanning the file.
+									
+									With --batch, the assemblies of several samples are filtered in parallel 
+									with the same Taxon IDs.
+									
 									-----------------------------------------------------------------------------"""))
 	
 	group0 = parser.add_argument_group("Input/output specifications")
-	group0.add_argument("-ko", "--kraken-output", dest="kraken_output", required=True, type=str, help="[MANDATORY] KRAKEN output")
+	group0.add_argument("-ko", "--kraken-output", dest="kraken_output", required=False, type=str, help="[MANDATORY, unless --batch is used] KRAKEN output")
 	group0.add_argument("-t", "--taxonid", dest="taxonid", required=True, type=str, help="[MANDATORY] List of Taxon IDs of interest")
-	group0.add_argument("-a", "--assembly", dest="assembly", type=str, required=True, help="[MANDATORY] Assembly (fasta)")
-	group0.add_argument("-o", "--output", dest="output", type=str, required=True, help="[OPTIONAL] Tag for output file name")
+	group0.add_argument("-a", "--assembly", dest="assembly", type=str, required=False, help="[MANDATORY, unless --batch is used] Assembly (fasta)")
+	group0.add_argument("-o", "--output", dest="output", type=str, required=False, help="[OPTIONAL] Tag for output file name")
+	group0.add_argument("--split", dest="split", action="store_true", help="[OPTIONAL] Write one fasta file per Taxon ID (<output>_<taxon id>.fasta)")
+	group0.add_argument("--include-descendants", dest="nodes", type=str, default=None, help="[OPTIONAL] NCBI taxonomy nodes.dmp used to also keep the \
+						descendants of the Taxon IDs of interest")
+	
+	group1 = parser.add_argument_group("Batch mode", "Filter the assemblies of several samples")
+	group1.add_argument("--batch", dest="batch", type=str, default=None, help="[OPTIONAL] TSV file with one sample per row and the columns 'kraken_output', \
+						'assembly' and 'output_tag'. -ko, -a and -o are ignored")
+	group1.add_argument("--threads", dest="threads", type=int, default=1, help="[OPTIONAL] Number of samples filtered in parallel. Default = 1")
 
 	args = parser.parse_args()
 	
+	if args.batch is None and (args.kraken_output is None or args.assembly is None or args.output is None):
+		parser.error("-ko, -a and -o (or a sample sheet with --batch) are required")
+	
 	ids = get_ids(args.taxonid)
-	contigs = get_contigs(ids, args.kraken_output)
-	flt_fasta(contigs, args.assembly, args.output)
+	assigned = None
+	if args.nodes is not None:
+		assigned = Taxonomy(args.nodes).targets(ids)
+	
+	if args.batch is not None:
+		samples = read_samples(args.batch)
+		print("Filtering " + str(len(samples)) + " samples...")
+		run_batch(samples, ids, assigned, args.split, args.threads)
+		sys.exit()
+	
+	contigs = get_contigs(ids, args.kraken_output, assigned)
+	kept, total = flt_fasta(contigs, args.assembly, args.output, args.split)
+	print("Kept " + str(kept) + " of " + str(total) + " contigs.")
@@ -8,82 +8,174 @@ By Veronica Mixao
 """ 
 
 import os
-import argparse
+import sys
 import glob
-from Bio import AlignIO
+import argparse
+import multiprocessing
+import numpy
+
+
+COORDS = {}
 
 
 # functions	---------
 
 def align2coords(alignment, reference):
 	""" obtain reference coordinates from a sequence alignment 
-	input: alignment
-	output: dictionary
+	input: alignment and reference name
+	output: array with the reference coordinate of each alignment column (position 0 = 0)
 	"""
 	
-	align = AlignIO.read(alignment, "fasta")
+	ref_seq = None
+	seq = None
+	with open(alignment, "rb") as infile:
+		for line in infile:
+			if line.startswith(b">"):
+				if seq is not None:
+					ref_seq = b"".join(seq)
+				seq = [] if line[1:].split()[0].decode() == reference else None
+			elif seq is not None:
+				seq.append(line.strip())
+	if seq is not None:
+		ref_seq = b"".join(seq)
 	
-	for record in align:
-		if record.id == reference:
-			ref_seq = record.seq
+	if ref_seq is None:
+		print("Reference " + reference + " was not found in " + alignment + "!!! Cannot continue!")
+		sys.exit()
 	
-	ref_coord = 0
-	align_coord = 0
-	coords = {}		
-	for nucl in ref_seq:
-		align_coord += 1
-		if nucl != "-":
-			ref_coord += 1
-		coords[align_coord] = ref_coord
+	nucl = numpy.frombuffer(ref_seq, dtype=numpy.uint8)
+	coords = numpy.zeros(len(nucl) + 1, dtype=numpy.int64)
+	numpy.cumsum(nucl != ord("-"), out=coords[1:])
 	
 	return coords
 
 
+def init_worker(coords):
+	""" share the reference coordinates with the processes of the pool """
+	
+	COORDS["coords"] = coords
+
+
+def process_gff(task):
+	""" obtain the merged bed file of a PHOBOS gff using the shared reference coordinates
+	input: (gff file, contig name, output name)
+	output: (gff file, number of intervals) """
+	
+	gff, ref, outname = task
+	poly = parse_gff(gff, COORDS["coords"])
+	write_bed(poly, ref, outname)
+	
+	return gff, sum(len(intervals) for intervals in poly.values())
+
+
+def gff_files(inputs):
+	""" get the list of gff files
+	input: list of gff files and/or directories with gff files
+	output: list of gff files """
+	
+	files = []
+	for path in inputs:
+		if os.path.isdir(path):
+			files += sorted(glob.glob(os.path.join(path, "*.gff")) + glob.glob(os.path.join(path, "*.gff3")))
+		else:
+			files.append(path)
+	
+	return files
+
+
+def parse_gff(gff, coords):
+	""" obtain the intervals of each poly type in reference coordinates from a PHOBOS gff
+	input: gff file and array with reference coordinates
+	output: dictionary with the sorted list of intervals per poly type
+	"""
+	
+	poly = {}
+	with open(gff) as ingff:
+		for line in ingff:
+			if "#" in line:
+				continue
+			l = line.split()
+			if len(l) < 5:
+				continue
+			start = int(l[3])
+			end = int(l[4])
+			details = l[17].split('"')[0] if len(l) > 17 else ""
+			
+			if details not in poly.keys():
+				poly[details] = []
+			poly[details].append((int(coords[start-1]), int(coords[end])))
+	
+	for key in poly:
+		poly[key] = merge_intervals(poly[key])
+	
+	return poly
+
+
+def merge_intervals(intervals):
+	""" merge overlapping and book-ended intervals (as bedtools merge)
+	input: list of (start, end)
+	output: sorted list of merged (start, end)
+	"""
+	
+	merged = []
+	for start,end in sorted(intervals):
+		if merged and start <= merged[-1][1]:
+			if end > merged[-1][1]:
+				merged[-1][1] = end
+		else:
+			merged.append([start, end])
+	
+	return [(start, end) for start,end in merged]
+
+
+def write_bed(poly, ref, outname):
+	""" write the intervals of all the poly types in a single bed file
+	input: dictionary with intervals per poly type, contig name and output name
+	"""
+	
+	with open(outname, "w+") as out:
+		for key in sorted(poly.keys()):
+			for start,end in poly[key]:
+				print(ref + "\t" + str(start) + "\t" + str(end) + "\t" + key, file = out)
+
+
 # pipeline	----------
-parser = argparse.ArgumentParser()
-parser.add_argument("-gff", "--phobos_gff", dest="gff", required=True, help="[MANDATORY] PHOBOS gff file with tandem repeats and sequence information")
-parser.add_argument("-align", "--alignment", dest="fasta", required=True, help="[MANDATORY] Sequence alignment (fasta format) used to run PHOBOS")
-parser.add_argument("-r", "--reference", dest="ref", required=True, help="[MANDATORY] Reference sequence in the alignment")
-parser.add_argument("-c", "--contig", dest="contig", required=True, help="[MANDATORY] Contig name used for read alignment")
-
-args = parser.parse_args()
-
-ref = args.contig 
-
-# get ref conversion
-coords = align2coords(args.fasta, args.ref)
-
-# process gff in bash
-os.system(" grep -v '#' " + args.gff + " Phobos_results.txt | awk '{ print $1, $4, $5, $18}' |  awk -F '\"' '{ print $1}' > tmp.gff")
-
-# generate a bed file per poly type
-poly = {}
-with open("tmp.gff") as ingff:
-	outname = ""
-	for line in ingff.readlines():
-		lin = line.split("\n")
-		l = lin[0].split(" ")
-		sample = l[0]
-		start = int(l[1])
-		end = int(l[2])
-		details = l[3]
-		
-		if details not in poly.keys():
-			poly[details] = []
-		info = str(coords[start-1]),str(coords[end])
-		poly[details].append(info)
-
-for key in poly:
-	with open("poly_" + key + ".bed", "w+") as out:
-		for start,end in poly[key]:
-			print(ref + "\t" + start + "\t" + end + "\t" + key, file = out)
-os.system("rm tmp.gff")
-
-# intervals bedfile
-
-for filename in glob.glob("poly_A.bed"):
-	os.system("sort -k1,1 -k2,2n " + filename + " > tmp.bed")
-	os.system("bedtools merge -i tmp.bed -c 4 -o distinct > " + filename + "; rm tmp.bed")
-
-# generate a single bed file
-os.system("cat *bed > Final.bed; rm poly_*.bed")
+
+if __name__ == "__main__":
+	
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-gff", "--phobos_gff", dest="gff", required=True, nargs="+", help="[MANDATORY] PHOBOS gff file(s) with tandem repeats and sequence information, \
+						or directories with gff files (all obtained with the same alignment)")
+	parser.add_argument("-align", "--alignment", dest="fasta", required=True, help="[MANDATORY] Sequence alignment (fasta format) used to run PHOBOS")
+	parser.add_argument("-r", "--reference", dest="ref", required=True, help="[MANDATORY] Reference sequence in the alignment")
+	parser.add_argument("-c", "--contig", dest="contig", required=True, help="[MANDATORY] Contig name used for read alignment")
+	parser.add_argument("-o", "--outdir", dest="outdir", default=None, help="[OPTIONAL] Output directory with one bed file per gff (<gff name>.bed). \
+						Default = Final.bed for a single gff and the current directory for several gffs")
+	parser.add_argument("-t", "--threads", dest="threads", type=int, default=1, help="[OPTIONAL] Number of gff files processed in parallel. Default = 1")
+	
+	args = parser.parse_args()
+	
+	ref = args.contig 
+	
+	# get ref conversion
+	coords = align2coords(args.fasta, args.ref)
+	
+	# get outputs
+	files = gff_files(args.gff)
+	if len(files) == 1 and args.outdir is None:
+		tasks = [(files[0], ref, "Final.bed")]
+	else:
+		outdir = "." if args.outdir is None else args.outdir
+		os.makedirs(outdir, exist_ok=True)
+		tasks = [(gff, ref, os.path.join(outdir, os.path.splitext(os.path.basename(gff))[0] + ".bed")) for gff in files]
+	
+	# generate the merged bed file of each gff
+	if args.threads > 1 and len(tasks) > 1:
+		with multiprocessing.Pool(min(args.threads, len(tasks)), initializer=init_worker, initargs=(coords,)) as pool:
+			results = list(pool.imap_unordered(process_gff, tasks))
+	else:
+		init_worker(coords)
+		results = [process_gff(task) for task in tasks]
+	
+	for gff, intervals in sorted(results):
+		print(gff + ": " + str(intervals) + " intervals")
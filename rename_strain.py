@@ -11,13 +11,13 @@ vmixao@gmail.com
 
 import argparse
 import os
+import re
+import sys
+import gzip
+import multiprocessing
 
-parser = argparse.ArgumentParser(description="Converting strain names in your filenames or fasta sequences (requires a conversion table)")
-parser.add_argument("-c", "--conv_table", dest="conv_table", action="store", required=True, help="Conversion table with the structure: original name \"t\" final name")
-parser.add_argument("-a", "--action", dest="action", action= "store", default="filename", help="Action to be performed: rename file names [filenames] or rename sequences in fasta file [sequences]. \nDefault = filenames")
-parser.add_argument("-i", "--input", dest="input", action= "store", required=True, nargs="+", help="Files to modify")
-
-args = parser.parse_args()
+BLOCK_SIZE = 2**24 # bytes read at once when renaming sequences
+FASTQ_NAME = re.compile(r"^(?P<strain>.+?)(?:_S\d+_L\d+)?(?P<plus>_[^_]*_[^_]*)$") # strain[_S*_L*]_R1_001.fastq.gz
 
 
 ##################
@@ -45,32 +45,170 @@ def conversion_table(conversion_table):
 #RENAMING SEQUENCES#
 ####################
 
-def	sequences(conv, filenames):
+def	rename_headers(conv, data, out):
+	""" write complete fasta lines renaming the headers found in the conversion table
+	and copying the other lines as they are; returns the number of renamed and missing headers """
 	
-	for filename in filenames:
-		print("\nWorking on file", filename, "\n")
-		
-		if filename.endswith(".fa") or filename.endswith("fasta"):
-			with open(filename.rsplit(".", 1)[0] + ".renamed." + filename.split(".")[-1], "w+") as out:
-				with open(filename, "r") as f_open:
-					f = f_open.readlines()
-					
-					for line in f:
-						l = line.split("\n")
-						if ">" in line:
-							sequence_name = l[0].split(">")[1]
-							if sequence_name in conv.keys():
-								new_sequence_name = conv[sequence_name]
-								print(">" + new_sequence_name, file = out)
-								print("Old name: ", sequence_name, " ; New name: ", new_sequence_name)
-							else:
-								print("Error!! ", sequence_name, " was not found in the conversion table!")
-								print(l[0], file = out)
-						else:
-								print(l[0], file = out)		
+	renamed = 0
+	missing = 0
+	pos = 0
+	while pos < len(data):
+		start = pos if data.startswith(b">", pos) else data.find(b"\n>", pos)
+		if start == -1:
+			out.write(data[pos:])
+			break
+		if data[start] == ord("\n"):
+			start += 1
+		if start != pos:
+			out.write(data[pos:start])
 		
+		end = data.find(b"\n", start) + 1
+		sequence_name = data[start:end - 1].split(b">")[1]
+		if sequence_name in conv:
+			out.write(b">" + conv[sequence_name] + b"\n")
+			renamed += 1
+		else:
+			out.write(data[start:end])
+			missing += 1
+		pos = end
+	
+	return renamed, missing
+
+
+def	rename_file(task):
+	""" rename the sequences of one (gzipped) fasta file streaming it in blocks """
+	
+	conv, filename = task
+	name = filename[:-3] if filename.endswith(".gz") else filename
+	opener = gzip.open if filename.endswith(".gz") else open
+	outname = name.rsplit(".", 1)[0] + ".renamed." + name.split(".")[-1] + (".gz" if filename.endswith(".gz") else "")
+	
+	renamed = 0
+	missing = 0
+	with opener(filename, "rb") as f_open, opener(outname, "wb") as out:
+		tail = b""
+		while True:
+			block = f_open.read(BLOCK_SIZE)
+			if not block:
+				break
+			data = tail + block
+			end = data.rfind(b"\n") + 1
+			tail = data[end:]
+			counts = rename_headers(conv, data[:end], out)
+			renamed += counts[0]
+			missing += counts[1]
+		if tail:
+			counts = rename_headers(conv, tail + b"\n", out)
+			renamed += counts[0]
+			missing += counts[1]
+	
+	return filename, renamed, missing
+
+
+def	sequences(conv, filenames, threads=1):
+	
+	conv = {k.encode(): v.encode() for k, v in conv.items()}
+	tasks = []
+	for filename in filenames:
+		name = filename[:-3] if filename.endswith(".gz") else filename
+		if name.endswith(".fa") or name.endswith("fasta"):
+			tasks.append((conv, filename))
 		else:
-			print("ERROR! This option only accepts fasta files!") 
+			print("ERROR! This option only accepts fasta files!", filename) 
+	
+	if threads > 1 and len(tasks) > 1:
+		with multiprocessing.Pool(min(threads, len(tasks))) as pool:
+			results = list(pool.imap_unordered(rename_file, tasks))
+	else:
+		results = [rename_file(task) for task in tasks]
+	
+	total_renamed = 0
+	total_missing = 0
+	for filename, renamed, missing in sorted(results):
+		print("File", filename, ":", renamed, "sequences renamed ;", missing, "not found in the conversion table")
+		total_renamed += renamed
+		total_missing += missing
+	print("Total:", total_renamed, "sequences renamed ;", total_missing, "not found in the conversion table")
+
+
+###############
+#RENAMING TEXT#
+###############
+
+def	trie_pattern(node):
+	""" regular expression matching all the words of a trie (nested dictionaries, "" marks the end of a word) """
+	
+	alternatives = [re.escape(char) + trie_pattern(node[char]) for char in sorted(node) if char != ""]
+	if len(alternatives) == 0:
+		return ""
+	if len(alternatives) == 1 and "" not in node:
+		return alternatives[0]
+	
+	pattern = "(?:" + "|".join(alternatives) + ")"
+	if "" in node:
+		pattern += "?"
+	return pattern
+
+
+def	names_regex(conv, token_chars):
+	""" compile the names of the conversion table into a single trie-structured regular expression
+	that only matches whole tokens (not preceded or followed by one of the token characters);
+	None if the table has no names """
+	
+	trie = {}
+	for name in conv:
+		if name != "":
+			node = trie
+			for char in name:
+				node = node.setdefault(char, {})
+			node[""] = True
+	if len(trie) == 0:
+		return None
+	
+	return re.compile("(?<![" + token_chars + "])" + trie_pattern(trie) + "(?![" + token_chars + "])")
+
+
+def	rename_text_file(task):
+	""" rename the strains of one (gzipped) text file streaming it line by line """
+	
+	conv, regex, filename = task
+	name = filename[:-3] if filename.endswith(".gz") else filename
+	opener = gzip.open if filename.endswith(".gz") else open
+	if "." in os.path.basename(name):
+		outname = name.rsplit(".", 1)[0] + ".renamed." + name.split(".")[-1]
+	else:
+		outname = name + ".renamed"
+	outname += ".gz" if filename.endswith(".gz") else ""
+	
+	replacements = 0
+	with opener(filename, "rt", newline="") as f_open, opener(outname, "wt", newline="") as out:
+		for line in f_open:
+			if regex is not None:
+				line, n = regex.subn(lambda match: conv[match.group(0)], line)
+				replacements += n
+			out.write(line)
+	
+	return filename, replacements
+
+
+def	text(conv, filenames, token_chars, threads=1):
+	
+	regex = names_regex(conv, token_chars)
+	if regex is None:
+		print("WARNING!!! The conversion table has no names! The files will be copied unchanged!")
+	tasks = [(conv, regex, filename) for filename in filenames]
+	
+	if threads > 1 and len(tasks) > 1:
+		with multiprocessing.Pool(min(threads, len(tasks))) as pool:
+			results = list(pool.imap_unordered(rename_text_file, tasks))
+	else:
+		results = [rename_text_file(task) for task in tasks]
+	
+	total = 0
+	for filename, replacements in sorted(results):
+		print("File", filename, ":", replacements, "names renamed")
+		total += replacements
+	print("Total:", total, "names renamed")
 
 
 ####################
@@ -110,16 +248,155 @@ def	filenames(conv, filenames):
 		else:
 			print("WARNING!!! Strain", strain, " was not found in the conversion table!\n")
 
+def	split_filename(filename):
+	""" get the strain and the rest of a file name (None if it cannot be parsed) """
+	
+	if ".fq" in filename or ".fastq" in filename: #fastqfile
+		match = FASTQ_NAME.match(filename)
+		if match is None:
+			return None
+		return match.group("strain"), match.group("plus")
+	
+	if "." not in filename:
+		return None
+	strain, plus = filename.split(".", 1)
+	return strain, "." + plus
+
+
+def	rename_plan(conv, directory):
+	""" get the renaming plan of all the files of a directory and the problems found
+	(strains that are not in the table and collisions with other files or new names) """
+	
+	plan = []
+	missing = []
+	existing = set()
+	with os.scandir(directory) as entries:
+		for entry in entries:
+			existing.add(entry.name)
+			if not entry.is_file():
+				continue
+			parts = split_filename(entry.name)
+			if parts is None or parts[0] not in conv:
+				missing.append(entry.name)
+			else:
+				plan.append((entry.name, conv[parts[0]] + parts[1]))
+	
+	renamed = set(old for old, new in plan if old != new)
+	targets = set()
+	collisions = []
+	for old, new in plan:
+		if new in targets or (new in existing and new not in renamed and new != old):
+			collisions.append((old, new))
+		targets.add(new)
+	
+	return plan, missing, collisions
+
+
+def	apply_plan(plan, directory, journal):
+	""" rename the files of the plan, writing a journal (old path "\t" new path) that
+	can be used to roll back; if a renaming fails, the previous ones are undone """
+	
+	plan = [(os.path.join(directory, old), os.path.join(directory, new)) for old, new in plan if old != new]
+	with open(journal, "w+") as out:
+		for old, new in plan:
+			print(os.path.abspath(old) + "\t" + os.path.abspath(new), file = out)
+	
+	# two steps (through temporary names) so that a file can take the old name of another one
+	done = []
+	try:
+		for old, new in plan:
+			os.rename(old, old + ".renaming")
+			done.append((old + ".renaming", old))
+		for old, new in plan:
+			os.rename(old + ".renaming", new)
+			done.append((new, old + ".renaming"))
+	except OSError as err:
+		print("ERROR!", err, "- undoing the", len(done), "renamings already done!")
+		for new, old in reversed(done):
+			os.rename(new, old)
+		sys.exit()
+	
+	return len(plan)
+
+
+def	rollback(journal):
+	""" undo the renamings of a journal """
+	
+	with open(journal, "r") as f_open:
+		entries = [line.rstrip("\n").split("\t") for line in f_open if line.strip()]
+	
+	news = set(new for old, new in entries)
+	plan = []
+	for old, new in entries:
+		if os.path.exists(new) and (not os.path.exists(old) or old in news):
+			plan.append((new, old))
+		else:
+			print("WARNING!!!", new, "could not be renamed back to", old)
+	
+	renamed = apply_plan(plan, "", journal + ".rollback")
+	print("Renamed back", renamed, "of", len(entries), "files.")
+
+
+def	directory_filenames(conv, directory, journal, dry_run=False):
+	
+	plan, missing, collisions = rename_plan(conv, directory)
+	print(len(plan), "files to rename ;", len(missing), "files without a strain in the conversion table")
+	
+	if len(collisions) > 0:
+		for old, new in collisions:
+			print("ERROR! THE NEW OS PATH EXISTS!", old, "->", new)
+		print("ERROR!", len(collisions), "collisions were found! Nothing was renamed!")
+		sys.exit()
+	
+	if dry_run:
+		for old, new in plan:
+			print("Old name: ", old, " ; New name: ", new)
+		for name in missing:
+			print("WARNING!!! Strain of", name, " was not found in the conversion table!")
+		return
+	
+	renamed = apply_plan(plan, directory, journal)
+	print("Renamed", renamed, "files. Journal:", journal)
+
 ###########
 #EXECUTING#
 ###########
 
-conversion_dict = conversion_table(args.conv_table)
-
-if args.action == "sequences":
-	sequences(conversion_dict,args.input)
-else:
-	if args.action == "filenames":
-		filenames(conversion_dict,args.input)
+if __name__ == "__main__":
+	
+	parser = argparse.ArgumentParser(description="Converting strain names in your filenames or fasta sequences (requires a conversion table)")
+	parser.add_argument("-c", "--conv_table", dest="conv_table", action="store", required=False, help="Conversion table with the structure: original name \"t\" final name")
+	parser.add_argument("-a", "--action", dest="action", action= "store", default="filename", help="Action to be performed: rename file names [filenames], rename sequences in fasta file [sequences] \
+						or rename the strain names found in any text file, e.g. trees, tables or fastq [text]. \nDefault = filenames")
+	parser.add_argument("-i", "--input", dest="input", action= "store", required=False, nargs="+", help="Files to modify")
+	parser.add_argument("--input-dir", dest="input_dir", action= "store", default=None, help="Rename all the files of a directory at once after checking \
+						that no new name collides with other files [filenames]")
+	parser.add_argument("--dry-run", dest="dry_run", action= "store_true", help="Only print the renaming plan of --input-dir")
+	parser.add_argument("--journal", dest="journal", action= "store", default="rename_journal.tsv", help="Journal with the renamings of --input-dir \
+						(used by --rollback). \nDefault = rename_journal.tsv")
+	parser.add_argument("--rollback", dest="rollback", action= "store", default=None, help="Undo the renamings of a journal")
+	parser.add_argument("-t", "--threads", dest="threads", action= "store", type=int, default=1, help="Number of files renamed in parallel [sequences, text]. \nDefault = 1")
+	parser.add_argument("--token-chars", dest="token_chars", action= "store", default="A-Za-z0-9_.-", help="Characters (regular expression class) that cannot \
+						surround a strain name for it to be renamed [text]. \nDefault = A-Za-z0-9_.-")
+	
+	args = parser.parse_args()
+	
+	if args.rollback is not None:
+		rollback(args.rollback)
+		sys.exit()
+	if args.conv_table is None or (args.input is None and args.input_dir is None):
+		parser.error("a conversion table (-c) and the files to modify (-i or --input-dir) are required")
+	
+	conversion_dict = conversion_table(args.conv_table)
+	
+	if args.input_dir is not None:
+		directory_filenames(conversion_dict,args.input_dir,args.journal,args.dry_run)
+	elif args.action == "sequences":
+		sequences(conversion_dict,args.input,args.threads)
+	elif args.action == "text":
+		text(conversion_dict,args.input,args.token_chars,args.threads)
 	else:
-		print("This action is not valid!")
+		if args.action == "filenames":
+			filenames(conversion_dict,args.input)
+		else:
+			print("This action is not valid!")
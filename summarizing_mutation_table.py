@@ -21,42 +21,74 @@ parser = argparse.ArgumentParser(description="This script is used to generate th
 parser.add_argument("-i", "--input", dest="input", action= "store", required=True, help="Input file")
 parser.add_argument("-o", "--output", dest="output", action= "store", required=True, help="Output file")
 parser.add_argument("-f", "--format", dest="format", action= "store", default="0", help="Output format: mutations in columns [0] or in rows [1]. Default [0]")
+parser.add_argument("-c", "--chunk-size", dest="chunk_size", action= "store", type=int, default=10000, help="Number of samples read at once. Default [10000]")
 
 args = parser.parse_args()
 
-def summary_mutations(infile, outfile, outformat):
-	filename  = infile
+def read_chunks(infile, chunksize):
+	""" read the binary table in chunks of samples with the mutations as a uint8 matrix
+	input: input file and number of rows per chunk
+	output: iterator of (sample ids, lineages, matrix) and list of mutations """
+	
+	mutations = [col for col in pandas.read_table(infile, nrows=0).columns if col != "SAMPLE_ID" and col != "Lineage"]
+	
+	def chunks():
+		for chunk in pandas.read_table(infile, chunksize=chunksize, dtype={"SAMPLE_ID": str, "Lineage": object}):
+			values = chunk[mutations]
+			if values.isna().values.any(): # missing values
+				values = values.fillna(0)
+			matrix = values.to_numpy(dtype=numpy.uint8)
+			yield chunk["SAMPLE_ID"].values, chunk["Lineage"].values, matrix
+	
+	return chunks(), mutations
 
-	data = pandas.read_table(filename)
-	data_out = {"lineage": [], "n_sequences": []}
-	lineages = data["Lineage"].values.tolist()
+def summary_mutations(infile, outfile, outformat, chunksize=10000):
 	
-	order_mutations = ["lineage", "n_sequences"]
+	chunks, mutations = read_chunks(infile, chunksize)
+	lineages = [] #lineages in order of appearance
+	index = {} #lineage -> row of the count matrix
+	samples = [] #set of sample ids per lineage
+	rows = [] #number of lines per lineage
+	counts = numpy.zeros((0, len(mutations)), dtype=numpy.int64)
 	
-	for lin in set(lineages):
-		flt_data = data[data.Lineage == lin] #filter the dataframe
-		if len(flt_data.SAMPLE_ID.unique()) != len(flt_data.Lineage): #compare number of unique sequences with the number of lines
-			#print(flt_data.SAMPLE_ID.unique(), flt_data.lineage)
-			print("Warning!!! You have a repetitive sequence in lineage ", lin)
+	for sample_ids, lins, matrix in chunks:
+		codes, uniques = pandas.factorize(lins, use_na_sentinel=False)
 		
-		#getting lineage and stats	
-		n_seq = len(flt_data.SAMPLE_ID.unique()) #number of different sequences
-		data_out["lineage"].append(lin)
-		data_out["n_sequences"].append(n_seq)
+		# map the chunk lineages to the rows of the count matrix
+		rows_chunk = numpy.empty(len(uniques), dtype=numpy.int64)
+		for i, lin in enumerate(uniques):
+			key = None if pandas.isna(lin) else lin
+			if key not in index:
+				index[key] = len(lineages)
+				lineages.append(lin)
+				samples.append(set())
+				rows.append(0)
+			rows_chunk[i] = index[key]
+		if len(lineages) > counts.shape[0]:
+			counts = numpy.vstack([counts, numpy.zeros((len(lineages) - counts.shape[0], len(mutations)), dtype=numpy.int64)])
 		
-		#getting mutation summary
-		for col in flt_data.columns:
-			if col != "SAMPLE_ID" and col != "Lineage":
-				counter = flt_data[col].sum()
-				if col not in data_out.keys():
-					data_out[col] = []
-					order_mutations.append(col)
-				data_out[col].append(counter)
-
-	new_data = pandas.DataFrame(data = data_out, columns = order_mutations)
+		# sum the rows of each lineage at once (equivalent to the lineage indicator matrix product)
+		order = numpy.argsort(codes, kind="stable")
+		sorted_codes = codes[order]
+		starts = numpy.flatnonzero(numpy.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+		if len(mutations) > 0:
+			counts[rows_chunk[sorted_codes[starts]]] += numpy.add.reduceat(matrix[order], starts, axis=0, dtype=numpy.int64)
+		
+		for code, sample_id in zip(codes, sample_ids):
+			samples[rows_chunk[code]].add(sample_id)
+		for code, n in zip(*numpy.unique(codes, return_counts=True)):
+			rows[rows_chunk[code]] += int(n)
+	
+	for i, lin in enumerate(lineages):
+		if len(samples[i]) != rows[i]: #compare number of unique sequences with the number of lines
+			print("Warning!!! You have a repetitive sequence in lineage ", lin)
+	
+	new_data = pandas.DataFrame(counts, columns = mutations)
+	new_data.insert(0, "n_sequences", [len(s) for s in samples]) #number of different sequences
+	new_data.insert(0, "lineage", lineages)
 	
 	if outformat == "0":
-		out = new_data.sort_values(by=["n_sequences"], ascending=False) #modify according to the sorting parameter
+		out = new_data.sort_values(by=["n_sequences"], ascending=False, kind="stable") #modify according to the sorting parameter
 		out.to_csv(outfile, index = False, header=True, sep ="\t")
 	else:
 		if outformat == "1":
@@ -65,5 +97,4 @@ def summary_mutations(infile, outfile, outformat):
 		else:
 			print("Please use a valid output format code!!!!!")
 
-summary_mutations(args.input, args.output, args.format)
-
+summary_mutations(args.input, args.output, args.format, args.chunk_size)